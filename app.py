@@ -1,9 +1,24 @@
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter
 import io
-import zipfile
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 import base64
+import json
+import time
+
+from assets import asset_registry
+from batch import default_workers, process_batch
+from instrumentation import StageRecorder, log_file, metrics, summarize
+from jobs import CANCELLED, DONE, QUEUED, job_manager
+from result_cache import content_digest, result_cache
+from results_store import THUMBNAIL_SIZE, ResultsStore, upload_thumbnails
+from watermark_engine import (ENCODER_PRESETS, JPEG_SUBSAMPLING, ImageTooLarge, WatermarkPlan, check_frames,
+                              compare_encoders, load_preview, open_image, parse_variants, prepared_cache,
+                              same_as_balanced)
+
+PREVIEW_SIZE = 800
+GALLERY_PAGE_SIZE = 9
 
 st.set_page_config(page_title="Professional Watermark Studio", layout="wide", initial_sidebar_state="expanded")
 
@@ -34,10 +49,78 @@ st.markdown('<h1 class="main-header">🎨 Professional Watermark Studio</h1>', u
 st.markdown('<p class="sub-header">Add stunning watermarks to your images with advanced customization</p>', unsafe_allow_html=True)
 
 # Initialize session state
-if 'processed_images' not in st.session_state:
-    st.session_state.processed_images = []
-if 'watermark_preview' not in st.session_state:
-    st.session_state.watermark_preview = None
+if 'results' not in st.session_state:
+    st.session_state.results = ResultsStore()
+if 'preview_base' not in st.session_state:
+    st.session_state.preview_base = None
+if 'watermark_lease' not in st.session_state:
+    st.session_state.watermark_lease = None
+
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
+# Per-upload header check and content hash, so reruns don't re-read or rehash the files
+if 'upload_checks' not in st.session_state:
+    st.session_state.upload_checks = {}
+if 'upload_digests' not in st.session_state:
+    st.session_state.upload_digests = {}
+
+
+def run_batch(job, results, files, settings, watermark_data, plan, prefix, collect_timings, **options):
+    # Runs on a job thread, so nothing in here may call Streamlit. Each result goes straight
+    # into the results store and its ZIP as it arrives.
+    batch = results.new_batch()
+    batch.settings = settings
+    recorder = StageRecorder() if collect_timings else None
+    reused = []
+    duplicates = []
+    
+    def collect_result(idx, result):
+        name = files[idx][0]
+        results.add_result(batch, name, result, plan, prefix)
+        if result.duplicate_of is not None:
+            duplicates.append(idx)
+        elif result.cached:
+            reused.append(idx)
+        if result.stages is not None:
+            batch.stages.append((name, result.stages))
+            log_file(name, result.stages)
+            metrics.observe(result.stages)
+    
+    started = time.perf_counter()
+    try:
+        with recorder.activate() if recorder else nullcontext():
+            process_batch(files, settings, watermark_data, progress=job.progress, on_result=collect_result,
+                          instrument=collect_timings, cancel=job.cancel_event, **options)
+            batch.finish()
+    except BaseException:
+        results.discard(batch)
+        raise
+    if recorder:
+        # ZIP writes happen in this process, outside any one file's worker
+        batch.stages.append(("(batch)", recorder.records))
+        metrics.observe(recorder.records)
+        batch.seconds = time.perf_counter() - started
+    if duplicates:
+        metrics.increment('duplicate_inputs_total', len(duplicates))
+    return {'processed': len(files), 'outputs': len(batch), 'reused': len(reused),
+            'duplicates': len(duplicates), 'duplicate_bytes': sum(len(files[idx][1]) for idx in duplicates)}
+
+
+@st.fragment(run_every=1.0)
+def job_status(job_id):
+    # Polls the background job; once it has finished the whole page reruns to show the results
+    job = job_manager.get(job_id)
+    if job is None or not job.active:
+        st.rerun()
+    if job.status == QUEUED:
+        st.info(f"⏳ Waiting for a free slot ({job_manager.queue_position(job)} job(s) ahead)")
+    else:
+        st.progress(job.fraction)
+        st.text(f"Processing {job.done}/{job.total}: {job.current or ''}")
+    if st.button("✖️ Cancel", key="cancel_job", use_container_width=True):
+        job.cancel()
+        st.rerun()
+
 
 # Sidebar for watermark settings
 with st.sidebar:
@@ -45,15 +128,44 @@ with st.sidebar:
     
     # Watermark Image Upload
     st.subheader("1️⃣ Upload Watermark")
-    watermark_image = st.file_uploader(
-        "Choose your watermark/logo (PNG with transparency recommended)", 
-        type=['png', 'jpg', 'jpeg', 'webp'],
-        help="PNG files with transparency work best for professional results"
-    )
+    library = asset_registry.names()
+    watermark_source = "Upload"
+    if library:
+        watermark_source = st.radio("Watermark Source", ["Upload", "Logo Library"], horizontal=True)
+    watermark_asset = None
+    if watermark_source == "Logo Library":
+        watermark_asset = asset_registry.by_name(st.selectbox("Logo", library))
+    else:
+        watermark_image = st.file_uploader(
+            "Choose your watermark/logo (PNG with transparency recommended)", 
+            type=['png', 'jpg', 'jpeg', 'webp'],
+            help="PNG files with transparency work best for professional results"
+        )
+        if watermark_image:
+            # Decoded once per distinct file for the whole server, then shared
+            watermark_asset = asset_registry.register(watermark_image.getvalue())
+            if watermark_asset.name is None:
+                library_name = st.text_input("Save to Logo Library as",
+                                             watermark_image.name.rsplit('.', 1)[0])
+                if st.button("📚 Add to Logo Library", use_container_width=True):
+                    try:
+                        asset_registry.register(watermark_asset.data, name=library_name.strip())
+                    except ValueError as exc:
+                        st.error(str(exc))
+                    else:
+                        st.rerun()
     
-    if watermark_image:
-        wm_preview = Image.open(watermark_image)
-        st.image(wm_preview, caption="Your Watermark", use_container_width=True)
+    # Hold a lease on the logo in use so the registry keeps it decoded
+    lease = st.session_state.watermark_lease
+    if lease is not None and lease.asset is not watermark_asset:
+        lease.release()
+        lease = st.session_state.watermark_lease = None
+    if watermark_asset is not None and lease is None:
+        st.session_state.watermark_lease = asset_registry.lease(watermark_asset)
+    
+    if watermark_asset:
+        wm_preview = watermark_asset.image
+        st.image(wm_preview, caption=watermark_asset.name or "Your Watermark", use_container_width=True)
         
         st.divider()
         
@@ -181,179 +293,69 @@ with st.sidebar:
         output_format = st.selectbox("Output Format", ["PNG", "JPEG", "WEBP"])
         if output_format == "JPEG":
             jpeg_quality = st.slider("JPEG Quality", 60, 100, 95, 5)
+        encoder_preset = st.selectbox("Encoder Preset", list(ENCODER_PRESETS), index=1,
+                                      help="Trade encode time against file size")
+        variants_spec = st.text_input("Output Variants", "", placeholder="full:JPEG, 2048:WEBP, 400:JPEG@80",
+                                      help="Comma-separated SIZE:FORMAT@QUALITY outputs cut from one render of "
+                                           "each image; SIZE is the longest edge in px or 'full'. "
+                                           "Leave empty for a single output in the format above.")
+        keep_frames = st.checkbox("Keep Animation Frames", value=True,
+                                  help="Animated GIF/WEBP and multi-page TIFF uploads keep every frame and their "
+                                       "own format; off, only the first frame is watermarked")
+        try:
+            output_variants_list = parse_variants(variants_spec)
+        except ValueError as exc:
+            st.error(str(exc))
+            output_variants_list = []
+        
+        # Per-format overrides on top of the preset; only options changed from it are kept
+        encoder_options = {}
+        
+        def encoder_option(key, value, preset_value):
+            if value != preset_value:
+                encoder_options[key] = value
+        
+        with st.expander("Encoder Options", expanded=False):
+            preset_options = ENCODER_PRESETS[encoder_preset][output_format]
+            if same_as_balanced(encoder_preset, output_format):
+                st.caption(f"For {output_format}, {encoder_preset} is the same as balanced: "
+                           "the encoder's defaults are already its fastest path")
+            if output_format == "PNG":
+                level = preset_options.get('compress_level', 6)
+                encoder_option('png_compress_level', st.slider("Compression Level", 0, 9, level,
+                                                               help="Higher is smaller and slower"), level)
+                optimize = preset_options.get('optimize', False)
+                encoder_option('png_optimize', st.checkbox("Optimize", value=optimize,
+                                                           help="Extra pass for the smallest file; much slower"),
+                               optimize)
+            elif output_format == "JPEG":
+                subsampling = preset_options.get('subsampling', "4:2:0")
+                encoder_option('jpeg_subsampling', st.selectbox("Chroma Subsampling", JPEG_SUBSAMPLING,
+                                                                index=JPEG_SUBSAMPLING.index(subsampling)),
+                               subsampling)
+                optimize = preset_options.get('optimize', False)
+                encoder_option('jpeg_optimize', st.checkbox("Optimize Huffman Tables", value=optimize), optimize)
+                progressive = preset_options.get('progressive', False)
+                encoder_option('jpeg_progressive', st.checkbox("Progressive", value=progressive), progressive)
+            else:
+                method = preset_options.get('method', 4)
+                encoder_option('webp_method', st.slider("Method", 0, 6, method,
+                                                        help="Higher is smaller and slower"), method)
+                encoder_option('webp_lossless', st.checkbox("Lossless", value=False), False)
         
         # Prefix/Suffix for filenames
         add_prefix = st.text_input("Add Filename Prefix", "watermarked_")
-
-def hex_to_rgba(hex_color, alpha=255):
-    hex_color = hex_color.lstrip('#')
-    rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-    return rgb + (alpha,)
-
-def get_position_coords(img_width, img_height, wm_width, wm_height, position, margin_x=30, margin_y=30):
-    positions = {
-        "Bottom Center (2/3)": ((img_width - wm_width) // 2, int(img_height * 2/3) - wm_height // 2),
-        "Bottom Right": (img_width - wm_width - margin_x, img_height - wm_height - margin_y),
-        "Bottom Left": (margin_x, img_height - wm_height - margin_y),
-        "Top Right": (img_width - wm_width - margin_x, margin_y),
-        "Top Left": (margin_x, margin_y),
-        "Center": ((img_width - wm_width) // 2, (img_height - wm_height) // 2),
-        "Bottom Center": ((img_width - wm_width) // 2, img_height - wm_height - margin_y),
-        "Top Center": ((img_width - wm_width) // 2, margin_y),
-        "Left Center": (margin_x, (img_height - wm_height) // 2),
-        "Right Center": (img_width - wm_width - margin_x, (img_height - wm_height) // 2)
-    }
-    return positions.get(position, positions["Bottom Center (2/3)"])
-
-def apply_watermark(image, watermark_img, settings):
-    img = image.copy()
-    if img.mode != 'RGBA':
-        img = img.convert('RGBA')
-    
-    wm = watermark_img.copy()
-    if wm.mode != 'RGBA':
-        wm = wm.convert('RGBA')
-    
-    # Apply color adjustments if enabled
-    if settings.get('adjust_colors', False):
-        wm = ImageEnhance.Brightness(wm).enhance(settings.get('brightness', 1.0))
-        wm = ImageEnhance.Contrast(wm).enhance(settings.get('contrast', 1.0))
-        wm = ImageEnhance.Color(wm).enhance(settings.get('saturation', 1.0))
-    
-    # Calculate size
-    if settings.get('scale_mode') == "Percentage of Image":
-        new_width = int(img.width * settings['scale'] / 100)
-        if settings.get('maintain_aspect', True):
-            aspect_ratio = wm.height / wm.width
-            new_height = int(new_width * aspect_ratio)
-        else:
-            new_height = int(img.height * settings['scale'] / 100)
-    elif settings.get('scale_mode') == "Fixed Width (px)":
-        new_width = settings['fixed_width']
-        aspect_ratio = wm.height / wm.width
-        new_height = int(new_width * aspect_ratio)
-    elif settings.get('scale_mode') == "Fixed Height (px)":
-        new_height = settings['fixed_height']
-        aspect_ratio = wm.width / wm.height
-        new_width = int(new_height * aspect_ratio)
-    else:  # Custom Size
-        new_width = settings['custom_width']
-        new_height = settings['custom_height']
-    
-    wm = wm.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Apply blur if enabled
-    if settings.get('add_blur', False):
-        wm = wm.filter(ImageFilter.GaussianBlur(radius=settings.get('blur_amount', 2)))
-    
-    # Rotate watermark
-    if settings.get('rotation', 0) != 0:
-        wm = wm.rotate(settings['rotation'], expand=True, resample=Image.Resampling.BICUBIC)
-    
-    # Adjust opacity
-    alpha = wm.split()[3]
-    alpha = ImageEnhance.Brightness(alpha).enhance(settings['opacity'] / 100)
-    wm.putalpha(alpha)
-    
-    # Create composite layer
-    layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
-    
-    # Check if tiling is enabled
-    if settings.get('tile_watermark', False):
-        spacing_x = settings.get('tile_spacing_x', 200)
-        spacing_y = settings.get('tile_spacing_y', 200)
-        
-        # Create tiled watermark
-        tile_wm = wm.copy()
-        if settings.get('tile_rotation', 0) != 0:
-            tile_wm = tile_wm.rotate(settings['tile_rotation'], expand=True, resample=Image.Resampling.BICUBIC)
-        
-        # Adjust tile opacity
-        tile_alpha = tile_wm.split()[3]
-        tile_alpha = ImageEnhance.Brightness(tile_alpha).enhance(settings.get('tile_opacity', 15) / 100)
-        tile_wm.putalpha(tile_alpha)
-        
-        # Tile across image
-        for y in range(-tile_wm.height, img.height + tile_wm.height, spacing_y):
-            for x in range(-tile_wm.width, img.width + tile_wm.width, spacing_x):
-                layer.paste(tile_wm, (x, y), tile_wm)
-    else:
-        # Add background box if enabled
-        if settings.get('add_background', False):
-            padding = settings.get('bg_padding', 15)
-            bg_width = wm.width + padding * 2
-            bg_height = wm.height + padding * 2
-            bg_img = Image.new('RGBA', (bg_width, bg_height), (0, 0, 0, 0))
-            bg_draw = ImageDraw.Draw(bg_img)
-            bg_color = hex_to_rgba(settings['bg_color'], int(255 * settings['bg_opacity'] / 100))
-            bg_draw.rectangle([0, 0, bg_width, bg_height], fill=bg_color)
-            
-            # Paste watermark on background
-            bg_img.paste(wm, (padding, padding), wm)
-            wm = bg_img
-        
-        # Add border if enabled
-        if settings.get('add_border', False):
-            border_width = settings.get('border_width', 3)
-            bordered = Image.new('RGBA', (wm.width + border_width*2, wm.height + border_width*2), (0, 0, 0, 0))
-            border_draw = ImageDraw.Draw(bordered)
-            border_color = hex_to_rgba(settings['border_color'], 255)
-            border_draw.rectangle([0, 0, bordered.width, bordered.height], outline=border_color, width=border_width)
-            bordered.paste(wm, (border_width, border_width), wm)
-            wm = bordered
-        
-        # Add shadow if enabled
-        if settings.get('add_shadow', False):
-            shadow_offset_x = settings.get('shadow_offset_x', 3)
-            shadow_offset_y = settings.get('shadow_offset_y', 3)
-            shadow_blur = settings.get('shadow_blur', 5)
-            shadow_opacity = settings.get('shadow_opacity', 50)
-            
-            # Create shadow layer
-            shadow = Image.new('RGBA', (wm.width + abs(shadow_offset_x)*2 + shadow_blur*2, 
-                                       wm.height + abs(shadow_offset_y)*2 + shadow_blur*2), (0, 0, 0, 0))
-            shadow_draw = ImageDraw.Draw(shadow)
-            shadow_color = (0, 0, 0, int(255 * shadow_opacity / 100))
-            
-            # Draw shadow rectangle
-            shadow_pos = (shadow_blur + abs(min(0, shadow_offset_x)), 
-                         shadow_blur + abs(min(0, shadow_offset_y)))
-            shadow_draw.rectangle([shadow_pos[0], shadow_pos[1], 
-                                  shadow_pos[0] + wm.width, shadow_pos[1] + wm.height], 
-                                 fill=shadow_color)
-            
-            # Blur shadow
-            shadow = shadow.filter(ImageFilter.GaussianBlur(radius=shadow_blur))
-            
-            # Paste watermark on shadow
-            wm_pos = (shadow_blur + abs(min(0, shadow_offset_x)) - shadow_offset_x,
-                     shadow_blur + abs(min(0, shadow_offset_y)) - shadow_offset_y)
-            shadow.paste(wm, wm_pos, wm)
-            wm = shadow
-        
-        # Get position
-        if settings.get('position') == "Custom Position":
-            x = int(img.width * settings['custom_x'] / 100) - wm.width // 2
-            y = int(img.height * settings['custom_y'] / 100) - wm.height // 2
-        else:
-            x, y = get_position_coords(img.width, img.height, wm.width, wm.height, 
-                                      settings['position'], settings.get('margin_x', 30), 
-                                      settings.get('margin_y', 30))
         
-        # Ensure watermark is within bounds
-        x = max(0, min(x, img.width - wm.width))
-        y = max(0, min(y, img.height - wm.height))
+        reuse_results = st.checkbox("Reuse Unchanged Results", value=result_cache.enabled,
+                                    disabled=not result_cache.enabled,
+                                    help="Serve images already rendered with the same settings and watermark from the disk cache")
         
-        layer.paste(wm, (x, y), wm)
-    
-    # Composite
-    result = Image.alpha_composite(img, layer)
-    
-    # Convert based on output format
-    if settings.get('output_format') == 'JPEG':
-        result = result.convert('RGB')
-    
-    return result
+        collect_timings = st.checkbox("Collect Timing Details", value=False,
+                                      help="Record per-stage timings for each file in the batch")
+        
+        max_workers = default_workers()
+        batch_workers = st.number_input("Parallel Workers", 1, max_workers, max_workers, 1,
+                                        help="Number of processes used for Process All Images")
 
 # Main content area
 col1, col2 = st.columns([1, 1])
@@ -364,26 +366,67 @@ with col1:
     
     uploaded_files = st.file_uploader(
         "Choose image(s)", 
-        type=['png', 'jpg', 'jpeg', 'webp', 'bmp', 'tiff'], 
+        type=['png', 'jpg', 'jpeg', 'webp', 'bmp', 'tiff', 'tif', 'gif'], 
         accept_multiple_files=True,
-        help="Supports PNG, JPEG, WEBP, BMP, and TIFF formats"
+        help="Supports PNG, JPEG, WEBP, BMP, TIFF and GIF formats"
     )
     
+    if uploaded_files:
+        # Refuse oversized inputs from their headers, before anything decodes them. The verdict
+        # is kept per upload, so reruns don't read the files again.
+        checks = st.session_state.upload_checks
+        current = {getattr(file, 'file_id', file.name) for file in uploaded_files}
+        for memo in (checks, st.session_state.upload_digests):
+            for stale in memo.keys() - current:
+                del memo[stale]
+        too_large = []
+        for file in uploaded_files:
+            file_key = getattr(file, 'file_id', file.name)
+            if file_key not in checks:
+                # (size verdict, verdict for keeping every frame), so toggling keep_frames needs no re-read
+                try:
+                    with open_image(io.BytesIO(file.getvalue()), name=file.name) as image:
+                        try:
+                            check_frames(image, name=file.name)
+                            checks[file_key] = (None, None)
+                        except ImageTooLarge as exc:
+                            checks[file_key] = (None, str(exc))
+                except ImageTooLarge as exc:
+                    checks[file_key] = (str(exc), None)
+            verdict = checks[file_key][0] or (keep_frames and checks[file_key][1])
+            if verdict:
+                too_large.append(file)
+                st.warning(f"⚠️ Skipping {verdict}")
+        uploaded_files = [file for file in uploaded_files if file not in too_large]
+    
     if uploaded_files:
         st.success(f"✅ {len(uploaded_files)} image(s) uploaded")
         
-        # Show thumbnails
-        with st.expander("📸 View Uploaded Images", expanded=False):
-            thumb_cols = st.columns(min(3, len(uploaded_files)))
-            for idx, file in enumerate(uploaded_files[:9]):  # Show first 9
-                with thumb_cols[idx % 3]:
-                    img = Image.open(file)
-                    st.image(img, caption=file.name, use_container_width=True)
-            if len(uploaded_files) > 9:
-                st.info(f"+ {len(uploaded_files) - 9} more images")
+        # Thumbnails are only built while the expander is open, nine per page, and come from
+        # the shared cache keyed by content, so reruns don't decode or resend the uploads
+        gallery = st.expander("📸 View Uploaded Images", expanded=False, key="upload_gallery", on_change="rerun")
+        with gallery:
+            if gallery.open:
+                pages = -(-len(uploaded_files) // GALLERY_PAGE_SIZE)
+                page = 1
+                if pages > 1:
+                    page = st.number_input("Page", 1, pages, 1, key="upload_gallery_page")
+                start = (page - 1) * GALLERY_PAGE_SIZE
+                shown = uploaded_files[start:start + GALLERY_PAGE_SIZE]
+                digests = st.session_state.upload_digests
+                thumb_cols = st.columns(min(3, len(shown)))
+                for idx, file in enumerate(shown):
+                    file_key = getattr(file, 'file_id', file.name)
+                    if file_key not in digests:
+                        digests[file_key] = content_digest(file.getvalue())
+                    with thumb_cols[idx % 3]:
+                        st.image(upload_thumbnails.get(digests[file_key], file.getvalue), caption=file.name,
+                                 use_container_width=True)
+                if pages > 1:
+                    st.caption(f"Images {start + 1}-{start + len(shown)} of {len(uploaded_files)}")
 
 # Process images
-if uploaded_files and watermark_image:
+if uploaded_files and watermark_asset:
     
     # Prepare settings dictionary
     settings = {
@@ -425,55 +468,137 @@ if uploaded_files and watermark_image:
         'saturation': saturation if adjust_colors else 1.0,
         'maintain_aspect': maintain_aspect,
         'output_format': output_format,
-        'jpeg_quality': jpeg_quality if output_format == "JPEG" else 95
+        'jpeg_quality': jpeg_quality if output_format == "JPEG" else 95,
+        'encoder_preset': encoder_preset,
+        **encoder_options,
+        'variants': output_variants_list or None,
+        'keep_frames': keep_frames,
     }
     
     with col2:
         st.subheader("✨ Preview & Results")
         
-        # Process button
-        if st.button("🚀 Process All Images", type="primary", use_container_width=True):
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            processed_images = []
-            wm_img = Image.open(watermark_image)
+        # Live preview on a reduced decode; full resolution only runs on Process All
+        with st.expander("👁️ Live Preview", expanded=True):
+            preview_idx = st.selectbox("Preview image", range(len(uploaded_files)),
+                                       format_func=lambda x: uploaded_files[x].name)
+            preview_file = uploaded_files[preview_idx]
+            preview_key = (getattr(preview_file, 'file_id', preview_file.name), PREVIEW_SIZE)
             
-            for idx, uploaded_file in enumerate(uploaded_files):
-                status_text.text(f"Processing {idx + 1}/{len(uploaded_files)}: {uploaded_file.name}")
-                
-                image = Image.open(uploaded_file)
-                watermarked = apply_watermark(image, wm_img, settings)
-                
-                # Save to memory
-                buf = io.BytesIO()
-                if output_format == "JPEG":
-                    watermarked.save(buf, format='JPEG', quality=settings['jpeg_quality'])
-                elif output_format == "WEBP":
-                    watermarked.save(buf, format='WEBP', quality=95)
-                else:
-                    watermarked.save(buf, format='PNG')
-                
-                # Generate filename
-                name, ext = uploaded_file.name.rsplit('.', 1)
-                new_filename = f"{add_prefix}{name}.{output_format.lower()}"
-                
-                processed_images.append({
-                    'name': new_filename,
-                    'data': buf.getvalue(),
-                    'image': watermarked
-                })
-                
-                progress_bar.progress((idx + 1) / len(uploaded_files))
+            # Keep only the current preview base so reruns skip the decode entirely
+            if st.session_state.preview_base is None or st.session_state.preview_base[0] != preview_key:
+                preview_file.seek(0)
+                st.session_state.preview_base = (preview_key, *load_preview(preview_file, PREVIEW_SIZE))
+                preview_file.seek(0)
+            _, preview_img, preview_factor = st.session_state.preview_base
             
-            status_text.text("✅ Processing complete!")
-            st.session_state.processed_images = processed_images
-            
-            # Show results
-            st.success(f"🎉 Successfully processed {len(processed_images)} images!")
+            settings_error = None
+            try:
+                preview_plan = WatermarkPlan.compile(settings, wm_preview, cache=prepared_cache,
+                                                     digest=watermark_asset.pixel_digest)
+                st.image(preview_plan.scaled(preview_factor).apply(preview_img),
+                         caption=f"Preview of {preview_file.name}", use_container_width=True)
+            except ValueError as exc:
+                settings_error = exc
+                st.error(f"Invalid settings: {exc}")
+        
+        # Batches run as background jobs on a server-wide queue, so reruns don't interrupt them
+        job = job_manager.get(st.session_state.job_id) if st.session_state.job_id else None
+        if st.button("🚀 Process All Images", type="primary", use_container_width=True,
+                     disabled=(job is not None and job.active) or settings_error is not None):
+            plan = WatermarkPlan.compile(settings, watermark_asset.image, cache=None)
+            files = [(f.name, f.getvalue()) for f in uploaded_files]
+            results = st.session_state.results
+            options = dict(workers=batch_workers, thumbnail_size=THUMBNAIL_SIZE,
+                           cache=result_cache if reuse_results else None)
+            watermark_data = watermark_asset.data
+            job = job_manager.submit(
+                lambda job: run_batch(job, results, files, settings, watermark_data, plan, add_prefix,
+                                      collect_timings, **options),
+                label=f"{len(files)} images")
+            st.session_state.job_id = job.id
+        
+        if job is not None and job.active:
+            job_status(job.id)
+        elif job is not None:
+            # Reported once, then the finished job is forgotten by this session
+            if job.status == DONE:
+                st.success(f"🎉 Successfully processed {job.result['processed']} images!"
+                           + (f" ({job.result['outputs']} output files)" if job.result['outputs'] != job.result['processed'] else "")
+                           + (f" ({job.result['reused']} unchanged, reused from cache)" if job.result['reused'] else ""))
+                if job.result['duplicates']:
+                    st.info(f"♻️ {job.result['duplicates']} duplicate upload(s) were rendered once and shared, "
+                            f"skipping {job.result['duplicate_bytes'] / 1e6:.1f} MB of decoding and encoding")
+            elif job.status == CANCELLED:
+                st.warning("Processing cancelled")
+            else:
+                st.error(f"❌ Processing failed: {job.error}")
+            st.session_state.job_id = None
     
     # Display processed images
-    if st.session_state.processed_images:
+    results = st.session_state.results
+    batch = results.latest
+    if batch:
+        entries = batch.entries
+        if batch.stages:
+            with st.expander("⏱️ Performance Details", expanded=False):
+                all_records = [record for _, records in batch.stages for record in records]
+                st.caption(f"{len(entries)} files in {batch.seconds:.2f}s wall time "
+                           f"({len(entries) / batch.seconds:.1f} files/s)")
+                st.table([{
+                    'Stage': row['stage'],
+                    'Calls': row['calls'],
+                    'Total (s)': round(row['seconds'], 3),
+                    'Mean (ms)': round(row['seconds'] / row['calls'] * 1000, 1),
+                    'Max (ms)': round(row['max_seconds'] * 1000, 1),
+                    'Output (MB)': round(row['bytes'] / 1e6, 1),
+                } for row in summarize(all_records)])
+                slowest = sorted(((name, sum(r['seconds'] for r in records), records)
+                                  for name, records in batch.stages if name != "(batch)"),
+                                 key=lambda item: item[1], reverse=True)[:10]
+                st.markdown("**Slowest files**")
+                st.table([{
+                    'File': name,
+                    'Total (ms)': round(seconds * 1000, 1),
+                    'Size': next((f"{r['width']}x{r['height']}" for r in records if r['stage'] == 'decode'), ""),
+                    'Slowest stage': max(records, key=lambda r: r['seconds'])['stage'],
+                } for name, seconds, records in slowest])
+                # What the encode stage measured for each file: time and encoded size
+                st.markdown(f"**Encode per file** ({batch.settings['encoder_preset']} preset)")
+                st.dataframe([{
+                    'File': name,
+                    'Encode (ms)': round(sum(r['seconds'] for r in records if r['stage'] == 'encode') * 1000, 1),
+                    'Output (KB)': round(sum(r['bytes'] for r in records if r['stage'] == 'encode') / 1024, 1),
+                } for name, records in batch.stages if name != "(batch)"], use_container_width=True,
+                    hide_index=True)
+                col_m1, col_m2 = st.columns(2)
+                with col_m1:
+                    st.download_button("📄 Timings (JSON)",
+                                       data=json.dumps([{'file': name, 'stages': records}
+                                                        for name, records in batch.stages], default=str),
+                                       file_name="watermark_timings.json", mime="application/json",
+                                       use_container_width=True)
+                with col_m2:
+                    st.download_button("📈 Prometheus Counters", data=metrics.prometheus(),
+                                       file_name="watermark_metrics.prom", mime="text/plain",
+                                       use_container_width=True)
+        
+        with st.expander("🗜️ Encoder Presets", expanded=False):
+            sample_idx = st.selectbox("Sample image", range(len(entries)), format_func=lambda x: entries[x].name,
+                                      key="encoder_sample")
+            if st.button("Compare presets", use_container_width=True):
+                sample = results.open_image(entries[sample_idx])
+                st.session_state.encoder_report = (batch.batch_id, entries[sample_idx].name,
+                                                   compare_encoders(sample, batch.settings))
+            report = st.session_state.get('encoder_report')
+            if report and report[0] == batch.batch_id:
+                st.caption(f"{batch.settings['output_format']} encode of {report[1]}")
+                st.table([{
+                    'Preset': row['preset'] + (" (same as balanced)" if row['same_as_balanced'] else ""),
+                    'Encode (ms)': round(row['seconds'] * 1000, 1),
+                    'Size (KB)': round(row['bytes'] / 1024, 1),
+                } for row in report[2]])
+        
         st.divider()
         
         # Display options
@@ -482,15 +607,17 @@ if uploaded_files and watermark_image:
         if display_mode == "Grid View":
             cols_per_row = st.slider("Images per row", 1, 4, 2)
             cols = st.columns(cols_per_row)
-            for idx, img_data in enumerate(st.session_state.processed_images):
+            for idx, entry in enumerate(entries):
                 with cols[idx % cols_per_row]:
-                    st.image(img_data['image'], caption=img_data['name'], use_container_width=True)
+                    st.image(entry.thumbnail, caption=entry.name, use_container_width=True)
         else:
             selected_idx = st.selectbox("Select image to view", 
-                                       range(len(st.session_state.processed_images)),
-                                       format_func=lambda x: st.session_state.processed_images[x]['name'])
-            st.image(st.session_state.processed_images[selected_idx]['image'], 
-                    caption=st.session_state.processed_images[selected_idx]['name'],
+                                       range(len(entries)),
+                                       format_func=lambda x: entries[x].name)
+            full_size = st.checkbox("Show full resolution", value=False,
+                                    help="Loads the full-size output instead of the preview")
+            st.image(results.read(entries[selected_idx]) if full_size else entries[selected_idx].thumbnail, 
+                    caption=entries[selected_idx].name,
                     use_container_width=True)
         
         st.divider()
@@ -501,48 +628,40 @@ if uploaded_files and watermark_image:
         col_d1, col_d2 = st.columns(2)
         
         with col_d1:
-            if len(st.session_state.processed_images) == 1:
-                st.download_button(
-                    label="💾 Download Image",
-                    data=st.session_state.processed_images[0]['data'],
-                    file_name=st.session_state.processed_images[0]['name'],
-                    mime=f"image/{output_format.lower()}",
-                    use_container_width=True
-                )
+            if len(entries) == 1:
+                selected_download = 0
+                label = "💾 Download Image"
             else:
                 # Individual downloads
                 selected_download = st.selectbox("Choose image to download",
-                                                range(len(st.session_state.processed_images)),
-                                                format_func=lambda x: st.session_state.processed_images[x]['name'])
-                st.download_button(
-                    label=f"💾 Download Selected",
-                    data=st.session_state.processed_images[selected_download]['data'],
-                    file_name=st.session_state.processed_images[selected_download]['name'],
-                    mime=f"image/{output_format.lower()}",
-                    use_container_width=True
-                )
+                                                range(len(entries)),
+                                                format_func=lambda x: entries[x].name)
+                label = "💾 Download Selected"
+            # Output bytes are only read when the button is clicked
+            st.download_button(
+                label=label,
+                data=partial(results.read, entries[selected_download]),
+                file_name=entries[selected_download].name,
+                mime=entries[selected_download].mime,
+                use_container_width=True
+            )
         
         with col_d2:
-            if len(st.session_state.processed_images) > 1:
-                # Create ZIP file
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for img_data in st.session_state.processed_images:
-                        zip_file.writestr(img_data['name'], img_data['data'])
-                
+            if len(entries) > 1:
+                # ZIP was streamed to a spooled temp file during processing; read only on click
                 st.download_button(
-                    label=f"📦 Download All as ZIP ({len(st.session_state.processed_images)} images)",
-                    data=zip_buffer.getvalue(),
+                    label=f"📦 Download All as ZIP ({len(entries)} images)",
+                    data=batch.archive.getvalue,
                     file_name=f"watermarked_batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
                     mime="application/zip",
                     use_container_width=True
                 )
 
-elif uploaded_files and not watermark_image:
+elif uploaded_files and not watermark_asset:
     with col2:
         st.warning("⚠️ Please upload a watermark image in the sidebar to continue")
         
-elif not uploaded_files and watermark_image:
+elif not uploaded_files and watermark_asset:
     with col2:
         st.info("📤 Upload your images to start watermarking")
         
@@ -0,0 +1,167 @@
+from PIL import Image
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import os
+import threading
+import weakref
+
+from result_cache import content_digest
+from watermark_engine import ImageTooLarge, open_watermark, watermark_digest
+
+# Decoded watermarks kept for the whole server. Named logos from WATERMARK_ASSET_DIR are
+# loaded at start-up and never evicted; uploads are evicted least recently used first
+# once nothing holds a lease on them.
+ASSET_DIR = os.environ.get('WATERMARK_ASSET_DIR')
+MAX_ASSETS = int(os.environ.get('WATERMARK_MAX_ASSETS', 64))
+MAX_ASSET_BYTES = int(os.environ.get('WATERMARK_ASSET_MEMORY_MB', 256)) * 1024 * 1024
+ASSET_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+logger = logging.getLogger('watermark.assets')
+
+
+@dataclass(eq=False)
+class WatermarkAsset:
+    digest: str
+    data: bytes
+    image: Image.Image
+    pixel_digest: str
+    name: str = None
+    refs: int = 0
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.image.width * self.image.height * 4
+
+
+class AssetLease:
+    # A session's hold on one asset. Released explicitly when the session switches logos,
+    # or by the garbage collector once the session state holding it goes away.
+
+    def __init__(self, registry, asset):
+        self.asset = asset
+        self._finalizer = weakref.finalize(self, registry.release, asset.digest)
+
+    def release(self):
+        self._finalizer()
+
+
+class AssetRegistry:
+    def __init__(self, max_entries=MAX_ASSETS, max_bytes=MAX_ASSET_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._assets = OrderedDict()
+        self._names = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register(self, data, name=None):
+        # Decode once per distinct file content; registering the same bytes again is a lookup
+        digest = content_digest(data)
+        with self._lock:
+            asset = self._assets.get(digest)
+            if asset is not None:
+                self._assets.move_to_end(digest)
+                self.hits += 1
+                if name and asset.name is None:
+                    self._name(asset, name)
+                return asset
+            self.misses += 1
+
+        image = open_watermark(data, name or "watermark")
+        image = image.convert('RGBA') if image.mode != 'RGBA' else image
+        asset = WatermarkAsset(digest=digest, data=data, image=image, pixel_digest=watermark_digest(image))
+
+        with self._lock:
+            # Another session may have registered the same bytes while this one decoded
+            existing = self._assets.get(digest)
+            if existing is not None:
+                if name and existing.name is None:
+                    self._name(existing, name)
+                return existing
+            if name:
+                self._name(asset, name)
+            self._assets[digest] = asset
+            self._bytes += asset.nbytes
+            self._evict()
+        return asset
+
+    def lease(self, asset):
+        with self._lock:
+            if self._assets.get(asset.digest) is not asset:
+                # Evicted since it was looked up; holding a lease brings it back
+                self._assets[asset.digest] = asset
+                self._bytes += asset.nbytes
+            asset.refs += 1
+            self._assets.move_to_end(asset.digest)
+        return AssetLease(self, asset)
+
+    def release(self, digest):
+        with self._lock:
+            asset = self._assets.get(digest)
+            if asset is not None and asset.refs > 0:
+                asset.refs -= 1
+                self._evict()
+
+    def get(self, digest):
+        with self._lock:
+            return self._assets.get(digest)
+
+    def by_name(self, name):
+        with self._lock:
+            digest = self._names.get(name)
+            return self._assets.get(digest) if digest else None
+
+    def names(self):
+        with self._lock:
+            return sorted(self._names)
+
+    def load_directory(self, directory):
+        # Register every logo in a directory under its file name (without extension)
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            stem, ext = os.path.splitext(entry.name)
+            if not entry.is_file() or ext.lower() not in ASSET_EXTENSIONS:
+                continue
+            try:
+                with open(entry.path, 'rb') as fp:
+                    self.register(fp.read(), name=stem)
+            except (OSError, Image.UnidentifiedImageError, ImageTooLarge) as exc:
+                logger.warning("Skipping watermark asset %s: %s", entry.path, exc)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._assets),
+                'named': len(self._names),
+                'bytes': self._bytes,
+                'leased': sum(1 for asset in self._assets.values() if asset.refs),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _name(self, asset, name):
+        if self._names.get(name) not in (None, asset.digest):
+            raise ValueError(f"A different watermark is already registered as {name!r}")
+        asset.name = name
+        self._names[name] = asset.digest
+
+    def _evict(self):
+        # Oldest first, skipping named and leased assets
+        for digest in list(self._assets):
+            if len(self._assets) <= self.max_entries and self._bytes <= self.max_bytes:
+                return
+            asset = self._assets[digest]
+            if asset.name is None and asset.refs == 0:
+                del self._assets[digest]
+                self._bytes -= asset.nbytes
+                self.evictions += 1
+
+
+# Shared by every session in the server process
+asset_registry = AssetRegistry()
+if ASSET_DIR:
+    asset_registry.load_directory(ASSET_DIR)
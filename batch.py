@@ -0,0 +1,291 @@
+from PIL import Image
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext, suppress
+from dataclasses import dataclass, replace
+import io
+import multiprocessing
+import os
+
+from instrumentation import StageRecorder, stage
+from result_cache import content_digest, result_key
+from results_store import make_thumbnail
+from watermark_engine import (MAX_ANIMATION_PIXELS, MAX_BATCH_PIXELS, MAX_IMAGE_PIXELS, ImageTooLarge,
+                              WatermarkPlan, check_frames, frame_count, open_image, open_watermark, output_variants,
+                              prepared_cache)
+
+# Plan compiled once per worker process by _init_worker. Only pool workers set it; batches
+# run in-process compile their own plan and pass it along, since several jobs share the process.
+_plan = None
+# Service workers (_init_service_worker) hold every preset and logo instead, and compile
+# a plan per (preset, logo) pair the first time a request asks for it
+_presets = {}
+_logos = {}
+_plans = {}
+
+
+class Cancelled(Exception):
+    pass
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def _compile(settings, watermark_data):
+    return WatermarkPlan.compile(settings, open_watermark(watermark_data), cache=prepared_cache)
+
+def _init_worker(settings, watermark_data):
+    global _plan
+    _plan = _compile(settings, watermark_data)
+
+@dataclass
+class RenderResult:
+    data: bytes
+    thumbnail: bytes = None
+    stages: list = None
+    cached: bool = False
+    # Content hash of the input, and the index of the file this result was rendered for
+    # when the input was a byte-identical duplicate of it
+    digest: str = None
+    duplicate_of: int = None
+    # Encoded bytes of each output variant, in plan.variants order; data is the first of them
+    variants: list = None
+    # Format of data; animated and multi-page inputs keep their own instead of the plan's
+    output_format: str = None
+
+
+def _render(data, thumbnail_size=None, instrument=False, plan=None):
+    # Decode -> watermark -> encode, entirely inside the worker. With thumbnail_size the
+    # preview is cut from the already decoded result; with instrument the per-stage
+    # timings of this file come back with it. plan defaults to the worker's own.
+    plan = plan or _plan
+    recorder = StageRecorder() if instrument else None
+    with recorder.activate() if recorder else nullcontext():
+        with stage('decode') as timer:
+            image = open_image(io.BytesIO(data))
+            image.load()
+            timer.output(image)
+        if plan.keeps_frames(image):
+            encoded, variants, output_format = plan.encode_frames(image), None, image.format
+            # Preview of the first frame, read back from the output
+            watermarked = Image.open(io.BytesIO(encoded)) if thumbnail_size is not None else None
+        else:
+            watermarked = plan.apply(image, in_place=True)
+            variants = plan.encode_variants(watermarked) if plan.variants else None
+            encoded = variants[0] if variants else plan.encode(watermarked)
+            output_format = plan.output_format
+        thumbnail = None
+        if thumbnail_size is not None:
+            with stage('thumbnail') as timer:
+                thumbnail = timer.output(make_thumbnail(watermarked, thumbnail_size))
+    return RenderResult(encoded, thumbnail, recorder.records if recorder else None, variants=variants,
+                        output_format=output_format)
+
+def _init_service_worker(presets, logos):
+    _presets.update(presets)
+    _logos.update(logos)
+
+def _service_plan(preset, logo):
+    plan = _plans.get((preset, logo))
+    if plan is None:
+        watermark = _logos[logo]
+        if isinstance(watermark, bytes):
+            # Decoded once per worker and shared by every preset that uses it
+            watermark = _logos[logo] = open_watermark(watermark, logo).convert('RGBA')
+        plan = _plans[preset, logo] = WatermarkPlan.compile(_presets[preset], watermark, cache=prepared_cache)
+    return plan
+
+def _render_preset(preset, logo, data):
+    # One request of the HTTP service: encoded image in, (encoded watermarked image, format) out
+    plan = _service_plan(preset, logo)
+    image = open_image(io.BytesIO(data))
+    image.load()
+    if plan.keeps_frames(image):
+        return plan.encode_frames(image), image.format
+    return plan.encode(plan.apply(image, in_place=True)), plan.output_format
+
+def _render_path(src, dst, plan=None):
+    # File-to-file variant used by the CLI, so inputs and outputs never pass through the parent
+    plan = plan or _plan
+    tmp = f"{dst}.tmp{os.getpid()}"
+    try:
+        with open_image(src) as image:
+            if plan.keeps_frames(image):
+                # Multi-page TIFFs are patched up in place as pages are appended, hence w+b
+                with open(tmp, 'w+b') as fp:
+                    plan.encode_frames(image, fp)
+            else:
+                watermarked = plan.apply(image, in_place=True)
+                with open(tmp, 'wb') as fp:
+                    plan.encode(watermarked, fp)
+    except BaseException:
+        # A file that fails half-way leaves no partial output behind
+        with suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+# Failures of one input that on_error can take instead of the whole run: unreadable,
+# truncated or oversized files
+FILE_ERRORS = (OSError, SyntaxError, ValueError)
+
+def _run(func, tasks, labels, settings, watermark_data, workers, progress, on_result=None, cancel=None,
+         on_error=None):
+    # With on_error(idx, exc), a task failing with one of FILE_ERRORS is handed to it and the
+    # run carries on; its result stays None and progress is not called for it
+    total = len(tasks)
+    workers = max(1, min(workers or default_workers(), total or 1))
+    results = [None] * total
+
+    def deliver(idx, result):
+        # With on_result the caller takes ownership and nothing is retained here
+        if on_result:
+            on_result(idx, result)
+        else:
+            results[idx] = result
+
+    if workers == 1:
+        # Runs on the caller's thread, which may be one of several job threads
+        plan = _compile(settings, watermark_data)
+        for idx, args in enumerate(tasks):
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            try:
+                result = func(*args, plan=plan)
+            except FILE_ERRORS as exc:
+                if on_error is None:
+                    raise
+                on_error(idx, exc)
+                continue
+            deliver(idx, result)
+            if progress:
+                progress(idx + 1, total, labels[idx])
+        return results
+
+    # Settings and watermark bytes travel once per worker via the initializer, not per task.
+    # Submission is windowed so only a few inputs per worker sit in the pool's queues.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(dict(settings), watermark_data)) as pool:
+        pending = {}
+        next_idx = 0
+        done = 0
+        while done < total:
+            if cancel is not None and cancel.is_set():
+                # Files already in a worker finish; the rest are dropped
+                for future in pending:
+                    future.cancel()
+                raise Cancelled()
+            while next_idx < total and len(pending) < workers * 2:
+                pending[pool.submit(func, *tasks[next_idx])] = next_idx
+                next_idx += 1
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                idx = pending.pop(future)
+                done += 1
+                try:
+                    result = future.result()
+                except FILE_ERRORS as exc:
+                    if on_error is None:
+                        raise
+                    on_error(idx, exc)
+                    continue
+                deliver(idx, result)
+                if progress:
+                    progress(done, total, labels[idx])
+    return results
+
+def check_budget(files, max_image_pixels=MAX_IMAGE_PIXELS, max_batch_pixels=MAX_BATCH_PIXELS, count_frames=False,
+                 max_animation_pixels=MAX_ANIMATION_PIXELS):
+    # Header-only pass over (name, bytes) inputs, before any of them is decoded. Raises
+    # ImageTooLarge when one image or the batch as a whole is over budget; returns the
+    # batch's total pixel count. With count_frames every frame of an animation counts, and
+    # one over max_animation_pixels is refused on its own.
+    total = 0
+    for name, data in files:
+        with open_image(io.BytesIO(data), max_image_pixels, name) as image:
+            total += image.width * image.height * (check_frames(image, max_animation_pixels, name) if count_frames else 1)
+    if max_batch_pixels and total > max_batch_pixels:
+        raise ImageTooLarge(f"batch is {total / 1e6:.1f} MP in total, over the "
+                            f"{max_batch_pixels / 1e6:g} MP limit per batch")
+    return total
+
+def process_batch(files, settings, watermark_data, workers=None, progress=None, on_result=None,
+                  thumbnail_size=None, instrument=False, cache=None, cancel=None):
+    # files is a sequence of (name, bytes). Returns a RenderResult per file in input order, or
+    # hands each one to on_result(index, result) as it arrives when that callback is given.
+    # progress(done, total, name) is called from the calling thread as results arrive.
+    # Inputs with identical bytes are rendered once and the result is handed to each of them.
+    # With a ResultCache, files already rendered with the same settings and watermark are
+    # served from it first and only the rest go to the workers; each extra output variant is
+    # cached under its own key next to the first. Setting the threading.Event
+    # passed as cancel stops the batch between files by raising Cancelled.
+    files = list(files)
+    total = len(files)
+    results = [None] * total
+    deliver = on_result or results.__setitem__
+    digests = [content_digest(data) for _, data in files]
+    copies = {}
+    for idx, digest in enumerate(digests):
+        copies.setdefault(digest, []).append(idx)
+    unique = [indices[0] for indices in copies.values()]
+    check_budget([files[idx] for idx in unique], count_frames=settings.get('keep_frames', True))
+    done = 0
+
+    def fan_out(idx, result):
+        nonlocal done
+        result.digest = digests[idx]
+        for target in copies[digests[idx]]:
+            deliver(target, result if target == idx else replace(result, stages=None, duplicate_of=idx))
+            done += 1
+            if progress:
+                progress(done, total, files[target][0])
+
+    todo = unique
+    if cache is not None and cache.enabled:
+        watermark_key = content_digest(watermark_data)
+        keys = {idx: result_key(digests[idx], settings, watermark_key, thumbnail_size) for idx in unique}
+        variant_count = len(output_variants(settings))
+        todo = []
+        for idx in unique:
+            hit = cache.get(keys[idx])
+            variants = None
+            if hit is not None:
+                # Header-only read; a cached animation keeps the source's format and, like a
+                # fresh render of one, has no variants
+                with Image.open(io.BytesIO(hit[0])) as output:
+                    output_format = output.format
+                    animated = frame_count(output) > 1
+                if variant_count and not animated:
+                    extra = [cache.get(f"{keys[idx]}-{n}") for n in range(1, variant_count)]
+                    # Evicted separately, so one missing variant means rendering the file again
+                    if None in extra:
+                        hit = None
+                    else:
+                        variants = [hit[0]] + [data for data, _ in extra]
+            if hit is None:
+                todo.append(idx)
+            else:
+                fan_out(idx, RenderResult(*hit, cached=True, variants=variants, output_format=output_format))
+
+    def store(pos, result):
+        idx = todo[pos]
+        if cache is not None and cache.enabled:
+            cache.put(keys[idx], result.data, result.thumbnail)
+            for n, variant in enumerate((result.variants or [])[1:], 1):
+                cache.put(f"{keys[idx]}-{n}", variant)
+        fan_out(idx, result)
+
+    if todo:
+        _run(_render, [(files[idx][1], thumbnail_size, instrument) for idx in todo],
+             [files[idx][0] for idx in todo], settings, watermark_data, workers, None, store, cancel)
+    return results
+
+def process_paths(jobs, settings, watermark_data, workers=None, progress=None, on_error=None):
+    # jobs is a sequence of (source path, destination path). Returns output sizes in input order.
+    # With on_error(src, exc) a file that cannot be read or rendered is reported there, its
+    # size is None, and the other files still get done.
+    jobs = list(jobs)
+    handle = None if on_error is None else lambda idx, exc: on_error(jobs[idx][0], exc)
+    return _run(_render_path, jobs, [src for src, _ in jobs], settings, watermark_data, workers, progress,
+                on_error=handle)
@@ -0,0 +1,199 @@
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import time
+
+import PIL
+
+from export import StreamingZip
+from watermark_engine import DEFAULT_SETTINGS, ENCODER_PRESETS, PreparedWatermarkCache, WatermarkPlan
+
+# Synthetic source images: megapixels x mode. Each mode is stored in the format it usually
+# arrives in, so the decode stage is representative too.
+SIZES_MP = (1, 12, 24, 50)
+MODES = ('RGB', 'RGBA', 'L', 'P', 'I;16')
+SOURCE_FORMATS = {'RGB': 'JPEG', 'RGBA': 'PNG', 'L': 'PNG', 'P': 'PNG', 'I;16': 'TIFF'}
+
+PRESETS = {
+    'plain': {'add_shadow': False, 'output_format': 'JPEG', 'jpeg_quality': 90},
+    'effects': {'add_shadow': True, 'add_border': True, 'border_width': 4, 'border_color': "#FFFFFF",
+                'add_background': True, 'bg_color': "#202020", 'bg_opacity': 40, 'bg_padding': 20,
+                'output_format': 'PNG'},
+    'tiled': {'tile_watermark': True, 'tile_spacing_x': 60, 'tile_spacing_y': 60, 'tile_rotation': -30,
+              'tile_opacity': 20, 'scale': 8, 'output_format': 'WEBP'},
+    'rotated': {'rotation': 35, 'position': "Center", 'scale': 40, 'add_shadow': True,
+                'output_format': 'JPEG'},
+}
+
+STAGES = ('decode', 'prepare', 'apply', 'encode', 'zip')
+
+
+def make_watermark():
+    wm = Image.new('RGBA', (800, 300), (0, 0, 0, 0))
+    alpha = Image.radial_gradient('L').resize(wm.size).point(lambda v: 255 - v)
+    wm.paste(Image.new('RGBA', wm.size, (220, 40, 40, 255)), (0, 0), alpha)
+    return wm
+
+def make_source(megapixels, mode):
+    width = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    size = (width, int(megapixels * 1_000_000 / width))
+    # Gradients plus noise: compressible like a photo, not like a flat test card
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 24)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    if mode == 'RGBA':
+        image.putalpha(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+    elif mode == 'P':
+        image = image.quantize(256)
+    elif mode == 'I;16':
+        image = image.convert('L').point(lambda v: v * 257, 'I').convert('I;16')
+    elif mode != 'RGB':
+        image = image.convert(mode)
+    buf = io.BytesIO()
+    image.save(buf, format=SOURCE_FORMATS[mode])
+    return buf.getvalue()
+
+def _timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+def run_case(megapixels, mode, preset, repeat, encoder="balanced"):
+    # Runs in a fresh process so peak RSS belongs to this case alone
+    source = make_source(megapixels, mode)
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(PRESETS[preset])
+    settings['encoder_preset'] = encoder
+    watermark = make_watermark()
+    timings = {}
+
+    timings['decode'], image = _timed(lambda: _decode(source), repeat)
+    cold = WatermarkPlan.compile(settings, watermark, cache=None)
+    timings['prepare'], _ = _timed(lambda: cold.prepare(image.size), repeat)
+    plan = WatermarkPlan.compile(settings, watermark, cache=PreparedWatermarkCache())
+    plan.apply(image)
+    timings['apply'], result = _timed(lambda: plan.apply(image), repeat)
+    timings['encode'], data = _timed(lambda: plan.encode(result), repeat)
+    archive = StreamingZip()
+    timings['zip'], _ = _timed(lambda: archive.add(f"image.{plan.extension}", data), repeat)
+    archive.discard()
+
+    total = timings['decode'] + timings['apply'] + timings['encode'] + timings['zip']
+    pixels = image.width * image.height
+    return {
+        # Non-default encoders get their own case names, so baselines only compare like with like
+        'case': f"{megapixels}MP-{mode}-{preset}" + (f"-{encoder}" if encoder != "balanced" else ""),
+        'megapixels': round(pixels / 1e6, 2),
+        'mode': mode,
+        'preset': preset,
+        'encoder': encoder,
+        'output_bytes': len(data),
+        'stages': {stage: round(timings[stage], 6) for stage in STAGES},
+        'total': round(total, 6),
+        'throughput_mp_s': round(pixels / 1e6 / total, 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+def _decode(source):
+    image = Image.open(io.BytesIO(source))
+    image.load()
+    return image
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_suite(sizes, modes, presets, repeat, progress=None, encoders=("balanced",)):
+    cases = [(mp, mode, preset, encoder) for mp in sizes for mode in modes for preset in presets
+             for encoder in encoders]
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+        for mp, mode, preset, encoder in cases:
+            result = pool.submit(run_case, mp, mode, preset, repeat, encoder).result()
+            results.append(result)
+            if progress:
+                progress(result)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'repeat': repeat,
+        'results': results,
+    }
+
+def compare(current, baseline, tolerance, min_delta):
+    # A stage regresses when it is both `tolerance` slower relative to the baseline and
+    # at least `min_delta` seconds slower in absolute terms
+    previous = {r['case']: r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = previous.get(result['case'])
+        if old is None:
+            continue
+        for stage, seconds in result['stages'].items():
+            before = old['stages'].get(stage)
+            if before is None:
+                continue
+            if seconds > before * (1 + tolerance) and seconds - before > min_delta:
+                regressions.append((result['case'], stage, before, seconds))
+    return regressions
+
+def _format_row(result):
+    stages = '  '.join(f"{stage}={result['stages'][stage] * 1000:8.1f}ms" for stage in STAGES)
+    return (f"{result['case']:<33} {stages}  {result['throughput_mp_s']:7.2f} MP/s"
+            f"  {result['output_bytes'] / 1024:8.0f}KB  rss={result['peak_rss_mb']:7.1f}MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark apply_watermark and the encode/export path")
+    parser.add_argument('--sizes', type=float, nargs='+', default=SIZES_MP, help="Image sizes in megapixels")
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--presets', nargs='+', default=list(PRESETS), choices=list(PRESETS))
+    parser.add_argument('--encoders', nargs='+', default=["balanced"], choices=list(ENCODER_PRESETS),
+                        help="Encoder presets to run every case with")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage; the median is reported")
+    parser.add_argument('--quick', action='store_true', help="1MP only, one run per stage")
+    parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against a previously saved results file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative slowdown per stage")
+    parser.add_argument('--min-delta', type=float, default=0.005, help="Ignore slowdowns smaller than this (s)")
+    args = parser.parse_args(argv)
+
+    sizes = [mp if mp != int(mp) else int(mp) for mp in ([1] if args.quick else args.sizes)]
+    repeat = 1 if args.quick else args.repeat
+    current = run_suite(sizes, args.modes, args.presets, repeat, progress=lambda r: print(_format_row(r)),
+                        encoders=args.encoders)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(current, fp, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fp:
+            baseline = json.load(fp)
+        regressions = compare(current, baseline, args.tolerance, args.min_delta)
+        for case, stage, before, after in regressions:
+            print(f"REGRESSION {case} {stage}: {before * 1000:.1f}ms -> {after * 1000:.1f}ms "
+                  f"({after / before - 1:+.0%})", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+
+from batch import FILE_ERRORS, default_workers, process_paths
+from watermark_engine import (DEFAULT_SETTINGS, ImageTooLarge, WatermarkPlan, open_image, open_watermark,
+                              output_filename, settings_digest)
+
+INPUT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tiff', '.tif', '.gif')
+# Inputs that may be animated or multi-page, and then keep their own format
+MULTI_FRAME_EXTENSIONS = ('.gif', '.webp', '.tiff', '.tif')
+MANIFEST_NAME = '.watermark-manifest.json'
+
+
+def load_preset(path):
+    # JSON or YAML preset holding the same keys as the app's settings dict
+    with open(path, encoding='utf-8') as fp:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("YAML presets need PyYAML (pip install pyyaml)") from None
+            preset = yaml.safe_load(fp) or {}
+        else:
+            preset = json.load(fp)
+    if not isinstance(preset, dict):
+        raise SystemExit(f"Preset {path} must contain a mapping of settings")
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(preset)
+    return settings
+
+def collect_inputs(patterns, recursive=False):
+    # Expand directories and globs into (path, path relative to its input root) pairs
+    found = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            root = pattern
+            if recursive:
+                paths = (os.path.join(d, f) for d, _, files in os.walk(root) for f in files)
+            else:
+                paths = (os.path.join(root, f) for f in os.listdir(root))
+        else:
+            root = None
+            paths = glob.glob(pattern, recursive=True)
+        for path in sorted(paths):
+            if not os.path.isfile(path) or not path.lower().endswith(INPUT_EXTENSIONS):
+                continue
+            real = os.path.realpath(path)
+            if real in seen:
+                continue
+            seen.add(real)
+            found.append((path, os.path.relpath(path, root) if root else os.path.basename(path)))
+    return found
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def is_up_to_date(entry, src, dst, job):
+    # Cheap mtime/size check first; fall back to the content hash when only the mtime moved
+    if not entry or entry.get('job') != job or not os.path.exists(dst):
+        return False
+    stat = os.stat(src)
+    if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return True
+    if entry.get('size') == stat.st_size and entry.get('sha') == file_digest(src):
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+    return False
+
+def watermark_directory(inputs, output_dir, settings, watermark_path, prefix="watermarked_",
+                        workers=None, recursive=False, force=False, progress=None):
+    with open(watermark_path, 'rb') as fp:
+        watermark_data = fp.read()
+    # Compiling up front validates the preset before any worker starts
+    plan = WatermarkPlan.compile(settings, open_watermark(watermark_data, watermark_path), cache=None)
+    if plan.variants:
+        # One output file per input keeps the manifest and the up-to-date check simple
+        raise ValueError("Presets with output variants are not supported by the CLI; "
+                         "use the app for multi-output exports")
+    job = settings_digest(settings) + ':' + hashlib.blake2b(watermark_data, digest_size=16).hexdigest()
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    jobs = []
+    skipped = 0
+    too_large = []
+    failed = []
+    for src, rel in collect_inputs(inputs, recursive):
+        rel_dir, filename = os.path.split(rel)
+        extension = plan.extension
+        # Header check only; oversized and unreadable inputs are reported instead of failing the run
+        try:
+            with open_image(src, name=rel) as image:
+                if (settings.get('keep_frames', True) and filename.lower().endswith(MULTI_FRAME_EXTENSIONS)
+                        and plan.keeps_frames(image)):
+                    extension = image.format.lower()
+        except ImageTooLarge as exc:
+            too_large.append(str(exc))
+            continue
+        except FILE_ERRORS as exc:
+            failed.append(f"{rel}: {exc}")
+            continue
+        out_rel = os.path.join(rel_dir, output_filename(filename, prefix, extension))
+        dst = os.path.join(output_dir, out_rel)
+        if not force and is_up_to_date(manifest.get(out_rel), src, dst, job):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        jobs.append((src, dst, out_rel, rel))
+
+    # Record each output as it lands so an interrupted run resumes where it stopped.
+    # Files that fail to render are reported and left out of the manifest.
+    out_names = {src: out_rel for src, _, out_rel, _ in jobs}
+    in_names = {src: rel for src, _, _, rel in jobs}
+
+    def fail(src, exc):
+        failed.append(f"{in_names[src]}: {exc}")
+
+    def record(done, total, src):
+        stat = os.stat(src)
+        manifest[out_names[src]] = {'source': os.path.abspath(src), 'size': stat.st_size,
+                                    'mtime_ns': stat.st_mtime_ns, 'sha': file_digest(src), 'job': job}
+        if done % 500 == 0:
+            save_manifest(output_dir, manifest)
+        if progress:
+            progress(done, total, src)
+
+    try:
+        sizes = process_paths([(src, dst) for src, dst, _, _ in jobs], settings, watermark_data,
+                              workers=workers, progress=record, on_error=fail)
+    finally:
+        save_manifest(output_dir, manifest)
+    written = [size for size in sizes if size is not None]
+    return {'processed': len(written), 'skipped': skipped, 'too_large': too_large, 'failed': failed,
+            'bytes_written': sum(written)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a watermark preset to directories or globs of images")
+    parser.add_argument('inputs', nargs='+', help="Input files, directories or glob patterns")
+    parser.add_argument('-p', '--preset', required=True, help="JSON or YAML settings preset (without variants)")
+    parser.add_argument('-w', '--watermark', required=True, help="Watermark/logo image")
+    parser.add_argument('-o', '--output', required=True, help="Output directory")
+    parser.add_argument('--prefix', default=None, help="Filename prefix (default: preset add_prefix or 'watermarked_')")
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(), help="Worker processes")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Recurse into input directories")
+    parser.add_argument('-f', '--force', action='store_true', help="Reprocess files that are already up to date")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only print the summary")
+    args = parser.parse_args(argv)
+
+    settings = load_preset(args.preset)
+    prefix = args.prefix if args.prefix is not None else settings.pop('add_prefix', "watermarked_")
+    settings.pop('add_prefix', None)
+
+    def report(done, total, name):
+        print(f"[{done}/{total}] {name}", file=sys.stderr)
+
+    try:
+        summary = watermark_directory(args.inputs, args.output, settings, args.watermark, prefix=prefix,
+                                      workers=args.workers, recursive=args.recursive, force=args.force,
+                                      progress=None if args.quiet else report)
+    except ValueError as exc:
+        parser.error(str(exc))
+    for reason in summary['too_large']:
+        print(f"Skipped {reason}", file=sys.stderr)
+    for reason in summary['failed']:
+        print(f"Failed {reason}", file=sys.stderr)
+    print(f"Processed {summary['processed']}, skipped {summary['skipped']} up to date, "
+          f"{len(summary['too_large'])} too large and {len(summary['failed'])} unreadable, "
+          f"wrote {summary['bytes_written']} bytes")
+    # Non-zero so scheduled runs notice files that need attention
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
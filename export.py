@@ -0,0 +1,108 @@
+import io
+import tempfile
+import time
+import zipfile
+
+# Formats that are already compressed; deflating them again costs CPU and saves ~nothing
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip')
+
+
+def _zip_info(name):
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+class StreamingZip:
+    # ZIP archive built incrementally into a spooled temp file: small batches stay in memory,
+    # large ones roll over to disk, and each entry can be dropped as soon as it is added.
+
+    def __init__(self, max_memory=32 * 1024 * 1024):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._zip = zipfile.ZipFile(self._file, 'w')
+        self.count = 0
+
+    def add(self, name, data):
+        self._zip.writestr(_zip_info(name), data)
+        self.count += 1
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        return self
+
+    @property
+    def size(self):
+        self._file.seek(0, io.SEEK_END)
+        return self._file.tell()
+
+    def open(self):
+        # Rewound file object, e.g. for shutil.copyfileobj
+        self.close()
+        self._file.seek(0)
+        return self._file
+
+    def getvalue(self):
+        # Whole archive as bytes; meant to be passed uncalled as a deferred download
+        return self.open().read()
+
+    def discard(self):
+        self.close()
+        self._file.close()
+
+
+class _ChunkSink(io.RawIOBase):
+    # Unseekable write target, so zipfile streams entries with data descriptors
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipWriter:
+    # ZIP built one entry at a time for a streamed response: add() and close() return the
+    # bytes that are ready to send, so nothing but the current entry is held in memory.
+
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, 'w')
+        self.count = 0
+
+    def add(self, name, data):
+        self._zip.writestr(_zip_info(name), data)
+        self.count += 1
+        return self._sink.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._sink.drain()
+
+
+def iter_zip(entries):
+    # Yield a ZIP archive chunk by chunk from an iterable of (name, data) pairs.
+    # Only the entry currently being written is held in memory.
+    writer = ZipWriter()
+    for name, data in entries:
+        chunk = writer.add(name, data)
+        if chunk:
+            yield chunk
+    chunk = writer.close()
+    if chunk:
+        yield chunk
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+import contextvars
+import json
+import logging
+import threading
+import time
+
+# Opt-in per-stage timing. Code under measurement wraps work in `with stage('name') as s:`;
+# when no recorder is active that returns a shared no-op object, so the disabled cost is one
+# ContextVar lookup per stage.
+
+logger = logging.getLogger('watermark.metrics')
+
+_active = contextvars.ContextVar('watermark_stage_recorder', default=None)
+
+
+def _describe(obj):
+    # (bytes, width, height) of a stage's output: PIL image, NumPy array or encoded bytes
+    if hasattr(obj, 'getbands'):
+        return obj.width * obj.height * len(obj.getbands()), obj.width, obj.height
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'shape'):
+        return obj.nbytes, obj.shape[1], obj.shape[0]
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return len(obj), None, None
+    return 0, None, None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, obj):
+        return obj
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('recorder', 'name', 'start', 'bytes', 'width', 'height')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.bytes = 0
+        self.width = self.height = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.records.append({
+            'stage': self.name,
+            'seconds': time.perf_counter() - self.start,
+            'bytes': self.bytes,
+            'width': self.width,
+            'height': self.height,
+        })
+        return False
+
+    def output(self, obj):
+        # Attach the size of what the stage produced; returns obj for inline use
+        self.bytes, self.width, self.height = _describe(obj)
+        return obj
+
+
+class StageRecorder:
+    def __init__(self):
+        self.records = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    @contextmanager
+    def activate(self):
+        token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+
+def stage(name):
+    recorder = _active.get()
+    return _NULL_STAGE if recorder is None else recorder.stage(name)
+
+def summarize(records):
+    # Per-stage aggregate over a flat list of stage records
+    stages = {}
+    for record in records:
+        entry = stages.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'seconds': 0.0,
+                                                    'max_seconds': 0.0, 'bytes': 0})
+        entry['calls'] += 1
+        entry['seconds'] += record['seconds']
+        entry['max_seconds'] = max(entry['max_seconds'], record['seconds'])
+        entry['bytes'] += record['bytes']
+    return sorted(stages.values(), key=lambda entry: entry['seconds'], reverse=True)
+
+def log_file(name, records):
+    # One structured log line per file
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({'file': name, 'stages': records}, default=str))
+
+
+class MetricsRegistry:
+    # Process-wide counters, exposed in the Prometheus text format
+
+    def __init__(self, prefix='watermark'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._seconds = {}
+        self._calls = {}
+        self._bytes = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, records):
+        with self._lock:
+            for record in records:
+                name = record['stage']
+                self._seconds[name] = self._seconds.get(name, 0.0) + record['seconds']
+                self._calls[name] = self._calls.get(name, 0) + 1
+                self._bytes[name] = self._bytes.get(name, 0) + record['bytes']
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def prometheus(self):
+        with self._lock:
+            lines = []
+            for metric, values, help_text in (
+                ('stage_seconds_total', self._seconds, "Wall time spent per processing stage"),
+                ('stage_calls_total', self._calls, "Number of times each stage ran"),
+                ('stage_bytes_total', self._bytes, "Bytes produced per processing stage"),
+            ):
+                lines.append(f"# HELP {self.prefix}_{metric} {help_text}")
+                lines.append(f"# TYPE {self.prefix}_{metric} counter")
+                for name in sorted(values):
+                    lines.append(f'{self.prefix}_{metric}{{stage="{name}"}} {values[name]}')
+            for name in sorted(self._counters):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                lines.append(f"{self.prefix}_{name} {self._counters[name]}")
+            for name in sorted(self._gauges):
+                lines.append(f"# TYPE {self.prefix}_{name} gauge")
+                lines.append(f"{self.prefix}_{name} {self._gauges[name]}")
+            return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+import uuid
+
+from batch import Cancelled
+
+# Batches running at once across every session on the server; further jobs wait in the queue
+MAX_CONCURRENT_JOBS = int(os.environ.get('WATERMARK_MAX_JOBS', 2))
+# Finished jobs kept around for their sessions to pick up
+MAX_FINISHED_JOBS = 100
+
+logger = logging.getLogger('watermark.jobs')
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+
+class Job:
+    # State of one submitted batch. Written by the job's thread, read by whichever
+    # script run polls it; plain attribute writes keep the reads consistent enough.
+
+    def __init__(self, label=""):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.status = QUEUED
+        self.done = 0
+        self.total = 0
+        self.current = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self._future = None
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else 0.0
+
+    def progress(self, done, total, name):
+        # Matches the progress(done, total, name) callback of process_batch
+        self.done, self.total, self.current = done, total, name
+
+    def cancel(self):
+        self.cancel_event.set()
+        # A job that has not started yet never runs; a running one stops at its next file
+        if self._future is not None and self._future.cancel():
+            self.status = CANCELLED
+            self.finished = time.time()
+
+
+class JobManager:
+    # Process-wide queue of batch jobs. Jobs run on a fixed-size thread pool, so the number
+    # of batches in flight is capped for the whole server rather than per session.
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS, max_finished=MAX_FINISHED_JOBS):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='watermark-job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, func, label=""):
+        # func(job) does the work, reporting through job.progress and stopping when
+        # job.cancel_event is set; its return value becomes job.result
+        job = Job(label)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        job._future = self._executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_position(self, job):
+        # Number of queued jobs submitted before this one
+        with self._lock:
+            return sum(1 for other in self._jobs.values()
+                       if other.status == QUEUED and other.submitted < job.submitted)
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, CANCELLED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return dict(counts, max_concurrent=self.max_concurrent)
+
+    def _run(self, job, func):
+        if job.cancelled:
+            job.status = CANCELLED
+            job.finished = time.time()
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            job.result = func(job)
+            job.status = CANCELLED if job.cancelled else DONE
+        except Cancelled:
+            job.status = CANCELLED
+        except Exception as exc:
+            logger.exception("Job %s (%s) failed", job.id, job.label)
+            job.error = str(exc)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+
+# Shared by every session; lives as long as the server process
+job_manager = JobManager()
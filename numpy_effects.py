@@ -0,0 +1,141 @@
+from PIL import Image, ImageFilter
+import numpy as np
+
+import watermark_engine
+
+# NumPy versions of the watermark effect steps. They work on straight-alpha RGBA uint8 arrays
+# of shape (height, width, 4) and reproduce PIL's integer arithmetic, so results are
+# pixel-identical to the PIL chain (tolerance 0). Straight rather than premultiplied alpha
+# is kept because that is what PIL's paste() and ImageEnhance compute.
+
+
+def vectorized(func):
+    func.vectorized = True
+    return func
+
+def to_array(image):
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    return np.array(image)
+
+def to_image(array):
+    return Image.fromarray(array, 'RGBA')
+
+def _div255(value):
+    # PIL's rounding division by 255 (DIV255 in libImaging)
+    tmp = value + 128
+    return ((tmp >> 8) + tmp) >> 8
+
+def _blend_lut(base, factor):
+    # Image.blend(degenerate, image, factor) for one constant degenerate value, as a 256-entry
+    # table: float32 lerp, truncated toward zero and clipped to 0..255 like libImaging does
+    values = np.arange(256, dtype=np.float32)
+    out = np.float32(base) + np.float32(factor) * (values - np.float32(base))
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+def _luma(rgb):
+    # ITU-R 601-2 luma with the fixed-point rounding of Image.convert('L')
+    luma = rgb[..., 0].astype(np.uint32) * 19595
+    luma += rgb[..., 1].astype(np.uint32) * 38470
+    luma += rgb[..., 2].astype(np.uint32) * 7471
+    luma += 0x8000
+    luma >>= 16
+    return luma.astype(np.uint8)
+
+def paste_over(dst, src, x, y):
+    # In-place equivalent of Image.paste(src, (x, y), src) for RGBA arrays, clipped to dst.
+    # The weighted sum never exceeds 255 * 255 + 128, so uint16 holds PIL's DIV255 exactly.
+    height, width = dst.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + src.shape[1], width), min(y + src.shape[0], height)
+    if right <= left or bottom <= top:
+        return dst
+    src = src[top - y:bottom - y, left - x:right - x]
+    region = dst[top:bottom, left:right]
+    mask = src[..., 3:4].astype(np.uint16)
+    out = region.astype(np.uint16)
+    out *= 255 - mask
+    mask = mask * src
+    out += mask
+    out += 128
+    out += out >> 8
+    out >>= 8
+    region[...] = out
+    return dst
+
+def _scale_alpha(wm, factor):
+    alpha = wm[..., 3]
+    scaled = alpha.astype(np.float32)
+    scaled *= np.float32(factor)
+    np.clip(scaled, 0, 255, out=scaled)
+    alpha[...] = scaled.astype(np.uint8)
+    return wm
+
+@vectorized
+def adjust_colors(wm, settings):
+    # Brightness and contrast map each channel value independently, so they run as lookup
+    # tables; saturation depends on (luma, value) and uses a 256 x 256 table
+    rgb = wm[..., :3]
+    brightness = settings.get('brightness', 1.0)
+    if brightness != 1.0:
+        np.take(_blend_lut(0, brightness), rgb, out=rgb)
+    contrast = settings.get('contrast', 1.0)
+    if contrast != 1.0:
+        mean = int(_luma(rgb).mean() + 0.5)
+        np.take(_blend_lut(mean, contrast), rgb, out=rgb)
+    saturation = settings.get('saturation', 1.0)
+    if saturation != 1.0:
+        table = np.stack([_blend_lut(gray, saturation) for gray in range(256)])
+        gray = _luma(rgb)[..., None].astype(np.intp)
+        rgb[...] = table[gray, rgb]
+    return wm
+
+@vectorized
+def opacity(wm, settings):
+    return _scale_alpha(wm, settings['opacity'] / 100)
+
+@vectorized
+def tile_opacity(wm, settings):
+    return _scale_alpha(wm, settings.get('tile_opacity', 15) / 100)
+
+@vectorized
+def background(wm, settings):
+    padding = settings.get('bg_padding', 15)
+    canvas = np.empty((wm.shape[0] + padding * 2, wm.shape[1] + padding * 2, 4), np.uint8)
+    canvas[...] = watermark_engine.hex_to_rgba(settings['bg_color'], int(255 * settings['bg_opacity'] / 100))
+    return paste_over(canvas, wm, padding, padding)
+
+@vectorized
+def border(wm, settings):
+    border_width = settings.get('border_width', 3)
+    canvas = np.zeros((wm.shape[0] + border_width * 2, wm.shape[1] + border_width * 2, 4), np.uint8)
+    color = watermark_engine.hex_to_rgba(settings['border_color'], 255)
+    # ImageDraw outlines [0, 0, width, height], one pixel past the canvas, so the right and
+    # bottom bands come out one pixel narrower than the left and top ones
+    height, width = canvas.shape[:2]
+    canvas[:border_width] = color
+    canvas[height - border_width + 1:] = color
+    canvas[:, :border_width] = color
+    canvas[:, width - border_width + 1:] = color
+    return paste_over(canvas, wm, border_width, border_width)
+
+@vectorized
+def shadow(wm, settings):
+    shadow_offset_x = settings.get('shadow_offset_x', 3)
+    shadow_offset_y = settings.get('shadow_offset_y', 3)
+    shadow_blur = settings.get('shadow_blur', 5)
+    shadow_opacity = settings.get('shadow_opacity', 50)
+    height, width = wm.shape[:2]
+
+    # Only the alpha band of the shadow is non-zero, so only that band is drawn and blurred
+    alpha = np.zeros((height + abs(shadow_offset_y) * 2 + shadow_blur * 2,
+                      width + abs(shadow_offset_x) * 2 + shadow_blur * 2), np.uint8)
+    left = shadow_blur + abs(min(0, shadow_offset_x))
+    top = shadow_blur + abs(min(0, shadow_offset_y))
+    alpha[top:top + height + 1, left:left + width + 1] = int(255 * shadow_opacity / 100)
+    if shadow_blur:
+        alpha = np.asarray(Image.fromarray(alpha, 'L').filter(ImageFilter.GaussianBlur(radius=shadow_blur)))
+
+    canvas = np.zeros(alpha.shape + (4,), np.uint8)
+    canvas[..., 3] = alpha
+    return paste_over(canvas, wm, left - shadow_offset_x, top - shadow_offset_y)
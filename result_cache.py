@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+
+from watermark_engine import settings_digest
+
+# Default location and size of the shared render cache; WATERMARK_CACHE_MB=0 turns it off
+CACHE_DIR = os.environ.get('WATERMARK_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'watermark-cache')
+CACHE_MAX_BYTES = int(os.environ.get('WATERMARK_CACHE_MB', 1024)) * 1024 * 1024
+
+_HEADER = struct.Struct('<QQ')
+
+
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def result_key(data_digest, settings, watermark_digest, thumbnail_size=None):
+    # One rendered output per (input content, settings, watermark content, thumbnail size)
+    h = hashlib.blake2b(digest_size=20)
+    for part in (data_digest, settings_digest(settings), watermark_digest, repr(thumbnail_size)):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ResultCache:
+    # Encoded outputs and thumbnails on disk, one file per key, evicted least recently used
+    # first once the total size passes max_bytes. Shared by every session in the process;
+    # the index is rebuilt from the directory (oldest mtime first) on first use.
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        # (data, thumbnail) or None
+        if not self.enabled:
+            return None
+        with self._lock:
+            index = self._load_index()
+            if key not in index:
+                self.misses += 1
+                return None
+            index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                data_len, thumb_len = _HEADER.unpack(fp.read(_HEADER.size))
+                data = fp.read(data_len)
+                thumbnail = fp.read(thumb_len)
+            os.utime(path)
+        except (OSError, struct.error):
+            self._forget(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        if len(data) != data_len or len(thumbnail) != thumb_len:
+            self._forget(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data, thumbnail or None
+
+    def put(self, key, data, thumbnail=None):
+        if not self.enabled:
+            return
+        thumbnail = thumbnail or b''
+        size = _HEADER.size + len(data) + len(thumbnail)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'wb') as fp:
+                fp.write(_HEADER.pack(len(data), len(thumbnail)))
+                fp.write(data)
+                fp.write(thumbnail)
+            os.replace(tmp, path)
+        except OSError:
+            # A full or read-only disk only costs the cache, never the batch
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            index = self._load_index()
+            self._total_bytes += size - index.pop(key, 0)
+            index[key] = size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._load_index()):
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            index = self._load_index()
+            return {'entries': len(index), 'bytes': self._total_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _load_index(self):
+        if self._index is None:
+            found = []
+            try:
+                with os.scandir(self.directory) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.bin') and entry.is_file():
+                            stat = entry.stat()
+                            found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            except OSError:
+                pass
+            self._index = OrderedDict((key, size) for _, key, size in sorted(found))
+            self._total_bytes = sum(self._index.values())
+            self._evict()
+        return self._index
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self._total_bytes -= self._index.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _forget(self, key):
+        with self._lock:
+            if self._index is not None:
+                self._remove(key)
+
+
+result_cache = ResultCache()
@@ -0,0 +1,240 @@
+from PIL import Image
+from collections import OrderedDict
+from dataclasses import dataclass
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+from export import StreamingZip
+from instrumentation import stage
+from watermark_engine import load_preview, output_filename
+
+THUMBNAIL_SIZE = (512, 512)
+# Per-session limits; override with environment variables on shared servers
+MAX_MEMORY_BYTES = int(os.environ.get('WATERMARK_RESULTS_MEMORY_MB', 64)) * 1024 * 1024
+MAX_BATCHES = int(os.environ.get('WATERMARK_RESULTS_MAX_BATCHES', 2))
+# Previews of uploaded files, shared by every session
+UPLOAD_THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('WATERMARK_THUMBNAIL_CACHE_MB', 32)) * 1024 * 1024
+
+
+def make_thumbnail(image, size=THUMBNAIL_SIZE):
+    # Small encoded preview for the results widgets; JPEG unless transparency has to survive
+    thumb = image.copy()
+    thumb.thumbnail(size, Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    if thumb.mode in ('RGBA', 'LA', 'P'):
+        thumb.save(buf, format='PNG')
+    else:
+        thumb.convert('RGB').save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+class ThumbnailCache:
+    # Encoded thumbnails of uploads keyed by content hash. Each is made once, from a reduced
+    # decode, and the least recently used ones are evicted once max_bytes is reached.
+
+    def __init__(self, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest, data, size=UPLOAD_THUMBNAIL_SIZE):
+        # data is only read on a miss; it may be a callable returning the file's bytes
+        key = (digest, tuple(size))
+        with self._lock:
+            thumbnail = self._entries.get(key)
+            if thumbnail is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return thumbnail
+            self.misses += 1
+        image, _ = load_preview(io.BytesIO(data() if callable(data) else data), max(size))
+        thumbnail = make_thumbnail(image, size)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = thumbnail
+                self._bytes += len(thumbnail)
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+                    self.evictions += 1
+        return thumbnail
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+upload_thumbnails = ThumbnailCache()
+
+
+@dataclass
+class ResultEntry:
+    name: str
+    mime: str
+    size: int
+    thumbnail: bytes
+    data: bytes = None
+    path: str = None
+    # Same output as an earlier entry of the batch; its data, file and thumbnail are reused
+    shared: bool = False
+
+
+class ResultBatch:
+    def __init__(self, batch_id):
+        self.batch_id = batch_id
+        self.entries = []
+        self.archive = StreamingZip()
+        # Per-stage timing records, filled only when instrumentation is enabled
+        self.stages = []
+        self.seconds = None
+        self.complete = False
+        # First entry stored for each input content hash, for duplicates to share
+        self.by_digest = {}
+        # Settings the batch was rendered with
+        self.settings = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def finish(self):
+        self.archive.close()
+        self.complete = True
+
+
+class ResultsStore:
+    # Holds encoded outputs and thumbnails only. Once the in-memory budget is used up,
+    # further outputs are spilled to a temp directory; batches beyond max_batches are evicted.
+
+    def __init__(self, max_memory_bytes=MAX_MEMORY_BYTES, max_batches=MAX_BATCHES, spill_dir=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_batches = max(1, max_batches)
+        self._spill_root = spill_dir
+        self._spill_dir = None
+        self._batches = []
+        self._next_id = 0
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def latest(self):
+        # Most recent finished batch; one still being filled by a job is not shown yet
+        for batch in reversed(self._batches):
+            if batch.complete:
+                return batch
+        return None
+
+    @property
+    def memory_bytes(self):
+        return self._memory_bytes
+
+    def new_batch(self):
+        with self._lock:
+            self._next_id += 1
+            batch = ResultBatch(self._next_id)
+            self._batches.append(batch)
+            while len(self._batches) > self.max_batches:
+                self._evict(self._batches.pop(0))
+            return batch
+
+    def add(self, batch, name, data, thumbnail, mime, digest=None):
+        # digest is the input's content hash; a second input with the same one shares the
+        # first one's stored output instead of keeping another copy
+        entry = ResultEntry(name=name, mime=mime, size=len(data), thumbnail=thumbnail)
+        with self._lock:
+            original = batch.by_digest.get(digest) if digest else None
+            if original is not None:
+                entry.data, entry.path, entry.thumbnail = original.data, original.path, original.thumbnail
+                entry.shared = True
+            else:
+                if self._memory_bytes + len(data) + len(thumbnail) <= self.max_memory_bytes:
+                    entry.data = data
+                    self._memory_bytes += len(data)
+                else:
+                    entry.path = self._spill(batch, len(batch.entries), data)
+                self._memory_bytes += len(thumbnail)
+                if digest:
+                    batch.by_digest[digest] = entry
+            batch.entries.append(entry)
+        # ZIP members cannot safely share one local record (readers check the name in it),
+        # so a duplicate is written again; outputs are stored uncompressed, so that is a copy
+        with stage('zip') as timer:
+            batch.archive.add(name, data)
+            timer.output(data)
+        return entry
+
+    def add_result(self, batch, name, result, plan, prefix):
+        # Stores a process_batch RenderResult for the upload called name, under the names
+        # downstream consumers rely on: <prefix><stem>[_<size>px].<ext>, one entry per
+        # output variant. Returns the entries added.
+        if result.variants:
+            # Every variant of a file shares its thumbnail; duplicates share per variant
+            return [self.add(batch, variant.filename(name, prefix), data, result.thumbnail, variant.mime_type,
+                             digest=result.digest and f"{result.digest}{variant.suffix}.{variant.extension}")
+                    for variant, data in zip(plan.variants, result.variants)]
+        # Animations come back in their own format rather than the plan's
+        extension = (result.output_format or plan.output_format).lower()
+        return [self.add(batch, output_filename(name, prefix, extension), result.data, result.thumbnail,
+                         f"image/{extension}", digest=result.digest)]
+
+    def discard(self, batch):
+        with self._lock:
+            if batch in self._batches:
+                self._batches.remove(batch)
+            self._evict(batch)
+
+    def read(self, entry):
+        if entry.data is not None:
+            return entry.data
+        with open(entry.path, 'rb') as fp:
+            return fp.read()
+
+    def open_image(self, entry):
+        # Full-size decode, only when a view actually asks for it
+        return Image.open(io.BytesIO(self.read(entry)))
+
+    def clear(self):
+        with self._lock:
+            for batch in self._batches:
+                self._evict(batch)
+            self._batches = []
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def _spill(self, batch, idx, data):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='watermark-results-', dir=self._spill_root)
+        path = os.path.join(self._spill_dir, f"{batch.batch_id}-{idx}")
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def _evict(self, batch):
+        for entry in batch.entries:
+            if entry.shared:
+                continue
+            self._memory_bytes -= len(entry.thumbnail)
+            if entry.data is not None:
+                self._memory_bytes -= entry.size
+            elif entry.path is not None:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        batch.entries = []
+        batch.by_digest = {}
+        batch.stages = []
+        batch.archive.discard()
+
+    def __del__(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
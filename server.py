@@ -0,0 +1,576 @@
+from PIL import UnidentifiedImageError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from batch import _init_service_worker, _render_preset, default_workers
+from cli import load_preset
+from export import ZipWriter
+from instrumentation import metrics
+from watermark_engine import DEFAULT_SETTINGS, ImageTooLarge, WatermarkPlan, open_watermark, output_filename
+
+# Renders handed to the worker pool at once; 0 means two per worker
+MAX_IN_FLIGHT = int(os.environ.get('WATERMARK_MAX_IN_FLIGHT', 0))
+# Requests allowed to wait for a render slot before new ones are turned away with a 503
+MAX_QUEUE = int(os.environ.get('WATERMARK_MAX_QUEUE', 256))
+MAX_BODY_BYTES = int(os.environ.get('WATERMARK_MAX_BODY_MB', 256)) * 1024 * 1024
+KEEPALIVE_SECONDS = 30
+# Longest wait for the next piece of a request body; a stalled upload gets a 408 and gives
+# its slot back instead of holding it for as long as the client keeps the socket open
+BODY_TIMEOUT_SECONDS = float(os.environ.get('WATERMARK_BODY_TIMEOUT', 30))
+MAX_HEADERS = 100
+READ_CHUNK = 256 * 1024
+
+logger = logging.getLogger('watermark.server')
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None, headers=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers
+        self.body = body
+        connection = headers.get('connection', '').lower()
+        self.keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+
+class _Body:
+    # Request body read on demand, either Content-Length delimited or chunked. A client
+    # that sent "Expect: 100-continue" only gets the go-ahead once a handler starts reading,
+    # so requests rejected up front never upload their body.
+
+    def __init__(self, reader, writer, length, chunked, expect_continue, limit, timeout=BODY_TIMEOUT_SECONDS):
+        self._reader = reader
+        self._writer = writer
+        self._remaining = length
+        self._chunked = chunked
+        self._chunk_left = 0
+        self._continue = expect_continue
+        self._limit = limit
+        self._timeout = timeout
+        self.received = 0
+        self.done = not chunked and not length
+
+    async def read(self):
+        # Next piece of the body, b'' once it is exhausted
+        if self.done:
+            return b''
+        try:
+            return await asyncio.wait_for(self._read(), self._timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(408, f"No request body data for {self._timeout:g}s") from None
+
+    async def _read(self):
+        if self._continue:
+            self._continue = False
+            self._writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if self._chunked:
+            if not self._chunk_left:
+                line = await self._reader.readline()
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPError(400, "Malformed chunked body") from None
+                if not size:
+                    while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.done = True
+                    return b''
+                self._chunk_left = size
+            data = await self._reader.read(min(self._chunk_left, READ_CHUNK))
+            self._chunk_left -= len(data)
+            if data and not self._chunk_left:
+                await self._reader.readexactly(2)
+        else:
+            data = await self._reader.read(min(self._remaining, READ_CHUNK))
+            self._remaining -= len(data)
+            self.done = not self._remaining
+        if not data:
+            raise asyncio.IncompleteReadError(b'', None)
+        self.received += len(data)
+        if self.received > self._limit:
+            raise HTTPError(413, f"Request body is over the {self._limit // (1024 * 1024)} MB limit")
+        return data
+
+    async def read_all(self):
+        chunks = []
+        while chunk := await self.read():
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class _MultipartReader:
+    # Yields (filename, bytes) for each file part of a multipart/form-data body as soon as
+    # that part has arrived, so a batch is rendered while the rest is still uploading
+
+    def __init__(self, body, boundary):
+        self._body = body
+        self._delimiter = b'--' + boundary
+        self._buffer = bytearray()
+
+    async def _fill(self):
+        chunk = await self._body.read()
+        if not chunk:
+            raise HTTPError(400, "Truncated multipart body")
+        self._buffer += chunk
+
+    async def _read_until(self, separator):
+        start = 0
+        while (idx := self._buffer.find(separator, start)) < 0:
+            start = max(0, len(self._buffer) - len(separator) + 1)
+            await self._fill()
+        data = bytes(self._buffer[:idx])
+        del self._buffer[:idx + len(separator)]
+        return data
+
+    async def _read_exactly(self, size):
+        while len(self._buffer) < size:
+            await self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def parts(self):
+        await self._read_until(self._delimiter)
+        while True:
+            if await self._read_exactly(2) == b'--':
+                # Closing delimiter; whatever follows is epilogue
+                while await self._body.read():
+                    pass
+                return
+            head = (await self._read_until(b'\r\n\r\n')).decode('latin-1')
+            data = await self._read_until(b'\r\n' + self._delimiter)
+            match = re.search(r'filename="([^"]*)"', head)
+            if match and match.group(1):
+                yield os.path.basename(match.group(1).replace('\\', '/')), data
+
+
+async def _read_request(reader, writer, max_body, body_timeout=BODY_TIMEOUT_SECONDS):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line") from None
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n'):
+        if not line:
+            raise asyncio.IncompleteReadError(b'', None)
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(431)
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+    try:
+        length = 0 if chunked else int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length") from None
+    if length > max_body:
+        raise HTTPError(413, f"Request body is over the {max_body // (1024 * 1024)} MB limit")
+    expect_continue = headers.get('expect', '').lower() == '100-continue'
+    body = _Body(reader, writer, length, chunked, expect_continue, max_body, body_timeout)
+    return Request(method.upper(), target, version, headers, body)
+
+
+def _head(status, headers, keep_alive):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+
+async def _send(writer, status, body=b'', content_type='text/plain; charset=utf-8', headers=None, keep_alive=True):
+    if isinstance(body, str):
+        body = body.encode()
+    head = {'Content-Type': content_type, 'Content-Length': len(body), **(headers or {})}
+    writer.write(_head(status, head, keep_alive) + body)
+    await writer.drain()
+
+
+async def _send_chunk(writer, data):
+    # Waiting for drain is what pushes back on producers when the client reads slowly
+    if data:
+        writer.write(b'%x\r\n%b\r\n' % (len(data), data))
+        await writer.drain()
+
+
+class WatermarkService:
+    # HTTP front end for the watermark engine. The event loop only parses requests and
+    # moves bytes; decode, watermark and encode run in a process pool whose workers keep
+    # every logo decoded and every (preset, logo) plan compiled across requests.
+    #
+    #   POST /watermark?preset=NAME&logo=NAME  image bytes in, watermarked image out
+    #   POST /batch?preset=NAME&logo=NAME      multipart/form-data files in, streamed ZIP out
+    #   GET  /health                           JSON status, load and the available names
+    #   GET  /metrics                          Prometheus text format
+
+    def __init__(self, presets, logos, workers=None, max_in_flight=MAX_IN_FLIGHT, max_queue=MAX_QUEUE,
+                 max_body=MAX_BODY_BYTES, body_timeout=BODY_TIMEOUT_SECONDS):
+        # presets maps names to settings dicts (optionally with add_prefix), logos maps
+        # names to encoded watermark images
+        if not presets or not logos:
+            raise ValueError("The service needs at least one preset and one logo")
+        self.presets = {}
+        self.prefixes = {}
+        self.logos = dict(logos)
+        decoded = {}
+        for name, data in self.logos.items():
+            try:
+                decoded[name] = open_watermark(data, name)
+            except (OSError, SyntaxError) as exc:
+                raise ValueError(f"Logo {name!r} is not a readable image: {exc}") from None
+        sample = next(iter(decoded.values()))
+        for name, settings in presets.items():
+            settings = dict(settings)
+            self.prefixes[name] = settings.pop('add_prefix', "watermarked_")
+            # Compiling up front rejects a bad preset before any worker starts
+            plan = WatermarkPlan.compile(settings, sample, cache=None)
+            if plan.variants:
+                raise ValueError(f"Preset {name!r} lists output variants, which the service does not serve")
+            self.presets[name] = settings
+        self.workers = max(1, workers or default_workers())
+        self.max_in_flight = max(1, max_in_flight or self.workers * 2)
+        self.max_queue = max(0, max_queue)
+        self.max_body = max_body
+        self.body_timeout = body_timeout
+        self.in_flight = 0
+        self.pending = 0
+        self._slots = None
+        self._pool = None
+        self._routes = {
+            ('POST', '/watermark'): self._watermark,
+            ('POST', '/batch'): self._batch,
+            ('GET', '/health'): self._health,
+            ('GET', '/metrics'): self._metrics,
+        }
+
+    def _start_pool(self):
+        context = multiprocessing.get_context('spawn')
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                         initializer=_init_service_worker, initargs=(self.presets, self.logos))
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._start_pool()
+        return await asyncio.start_server(self.handle, host, port, limit=READ_CHUNK, backlog=1024)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _default(self, names, kind):
+        # The entry called "default", or the only one there is
+        if 'default' in names:
+            return 'default'
+        if len(names) == 1:
+            return next(iter(names))
+        raise HTTPError(400, f"Pass ?{kind}= with one of: {', '.join(sorted(names))}")
+
+    def _resolve(self, request):
+        preset = request.query.get('preset') or self._default(self.presets, 'preset')
+        logo = request.query.get('logo') or self._default(self.logos, 'logo')
+        if preset not in self.presets:
+            raise HTTPError(404, f"Unknown preset {preset!r}")
+        if logo not in self.logos:
+            raise HTTPError(404, f"Unknown logo {logo!r}")
+        return preset, logo
+
+    def _update_gauges(self):
+        metrics.set_gauge('http_in_flight', self.in_flight)
+        metrics.set_gauge('http_pending_requests', self.pending)
+
+    async def render(self, preset, logo, data):
+        # (encoded bytes, format); animations keep their own format rather than the preset's.
+        # At most max_in_flight renders sit in the pool; the rest wait here, in the loop
+        async with self._slots:
+            self.in_flight += 1
+            self._update_gauges()
+            start = time.perf_counter()
+            try:
+                result, output_format = await asyncio.get_running_loop().run_in_executor(
+                    self._pool, _render_preset, preset, logo, data)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); later requests get a fresh pool
+                logger.error("Worker pool broke; restarting it")
+                self.close()
+                self._start_pool()
+                raise HTTPError(500, "Worker process died while rendering") from None
+            finally:
+                self.in_flight -= 1
+                self._update_gauges()
+        metrics.observe([{'stage': 'render', 'seconds': time.perf_counter() - start, 'bytes': len(result)}])
+        return result, output_format
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        _read_request(reader, writer, self.max_body, self.body_timeout), KEEPALIVE_SECONDS)
+                except HTTPError as exc:
+                    await _send(writer, exc.status, str(exc), headers=exc.headers, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                keep_alive = await self.dispatch(request, writer)
+                # Leftover body bytes would be read as the next request
+                if not keep_alive or not request.body.done:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def dispatch(self, request, writer):
+        # Returns whether the connection can carry another request
+        metrics.increment('http_requests_total')
+        handler = self._routes.get((request.method, request.path))
+        try:
+            if handler is None:
+                allowed = [method for method, path in self._routes if path == request.path]
+                if allowed:
+                    raise HTTPError(405, headers={'Allow': ", ".join(allowed)})
+                raise HTTPError(404)
+            if request.method == 'POST':
+                # Turned away before the body is read, so an overloaded server costs the
+                # client one round trip instead of an upload
+                if self.pending >= self.max_in_flight + self.max_queue:
+                    metrics.increment('http_rejected_total')
+                    raise HTTPError(503, "Server is at capacity, retry shortly", {'Retry-After': 1})
+                self.pending += 1
+                self._update_gauges()
+                try:
+                    return await handler(request, writer)
+                finally:
+                    self.pending -= 1
+                    self._update_gauges()
+            return await handler(request, writer)
+        except HTTPError as exc:
+            metrics.increment('http_errors_total')
+            keep_alive = request.keep_alive and exc.status < 500 and request.body.done
+            await _send(writer, exc.status, str(exc) + "\n", headers=exc.headers, keep_alive=keep_alive)
+            return keep_alive
+
+    async def _render_or_raise(self, preset, logo, data):
+        try:
+            return await self.render(preset, logo, data)
+        except ImageTooLarge as exc:
+            raise HTTPError(413, str(exc)) from None
+        except UnidentifiedImageError:
+            raise HTTPError(415, "Not a supported image") from None
+        except HTTPError:
+            raise
+        except (OSError, SyntaxError) as exc:
+            # Recognised but undecodable, e.g. a truncated JPEG
+            raise HTTPError(422, f"Image could not be decoded: {exc}") from None
+        except Exception:
+            logger.exception("Rendering with preset %r failed", preset)
+            raise HTTPError(500, "Rendering failed") from None
+
+    async def _watermark(self, request, writer):
+        preset, logo = self._resolve(request)
+        data = await request.body.read_all()
+        if not data:
+            raise HTTPError(400, "Empty request body")
+        start = time.perf_counter()
+        result, output_format = await self._render_or_raise(preset, logo, data)
+        metrics.observe([{'stage': 'http_watermark', 'seconds': time.perf_counter() - start, 'bytes': len(result)}])
+        await _send(writer, 200, result, f"image/{output_format.lower()}", keep_alive=request.keep_alive)
+        return request.keep_alive
+
+    async def _batch(self, request, writer):
+        preset, logo = self._resolve(request)
+        content_type = request.headers.get('content-type', '')
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not content_type.startswith('multipart/form-data') or not match:
+            raise HTTPError(415, "Send files as multipart/form-data")
+        prefix = self.prefixes[preset]
+        start = time.perf_counter()
+
+        # Results go out in input order while later parts are still uploading and rendering.
+        # The window of unsent results is capped, and a slow reader stalls the sends, which
+        # in turn stops reading the upload.
+        archive = ZipWriter()
+        pending = deque()
+        names = set()
+        errors = []
+        started = False
+        sent = 0
+
+        async def flush(filename, task):
+            nonlocal started, sent
+            try:
+                result, output_format = await task
+            except HTTPError as exc:
+                errors.append({'file': filename, 'status': exc.status, 'error': str(exc)})
+                return
+            except Exception as exc:
+                logger.exception("Rendering %s failed", filename)
+                errors.append({'file': filename, 'status': 500, 'error': str(exc)})
+                return
+            extension = output_format.lower()
+            name = output_filename(filename, prefix, extension)
+            stem, counter = name.rsplit('.', 1)[0], 1
+            while name in names:
+                counter += 1
+                name = f"{stem}-{counter}.{extension}"
+            names.add(name)
+            if not started:
+                writer.write(_head(200, {'Content-Type': 'application/zip', 'Transfer-Encoding': 'chunked',
+                                         'Content-Disposition': 'attachment; filename="watermarked.zip"'},
+                                   request.keep_alive))
+                started = True
+            chunk = archive.add(name, result)
+            sent += len(chunk)
+            await _send_chunk(writer, chunk)
+
+        try:
+            async for filename, data in _MultipartReader(request.body, match.group(1).encode()).parts():
+                pending.append((filename, asyncio.ensure_future(self._render_or_raise(preset, logo, data))))
+                while pending and (pending[0][1].done() or len(pending) >= self.max_in_flight):
+                    await flush(*pending.popleft())
+            while pending:
+                await flush(*pending.popleft())
+        except BaseException:
+            for _, task in pending:
+                task.cancel()
+            if started:
+                # Too late for an error status; dropping the connection leaves the ZIP truncated
+                raise ConnectionError("Batch aborted mid-stream") from None
+            raise
+
+        if not started:
+            if not errors:
+                raise HTTPError(400, "No files in the request")
+            writer.write(_head(200, {'Content-Type': 'application/zip', 'Transfer-Encoding': 'chunked',
+                                     'Content-Disposition': 'attachment; filename="watermarked.zip"'},
+                               request.keep_alive))
+        if errors:
+            await _send_chunk(writer, archive.add('errors.json', json.dumps(errors, indent=1).encode()))
+        tail = archive.close()
+        sent += len(tail)
+        await _send_chunk(writer, tail)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        metrics.observe([{'stage': 'http_batch', 'seconds': time.perf_counter() - start, 'bytes': sent}])
+        return request.keep_alive
+
+    async def _health(self, request, writer):
+        body = {
+            'status': 'ok',
+            'accepting': self.pending < self.max_in_flight + self.max_queue,
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'pending': self.pending,
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'presets': sorted(self.presets),
+            'logos': sorted(self.logos),
+        }
+        await _send(writer, 200, json.dumps(body), 'application/json', keep_alive=request.keep_alive)
+        return request.keep_alive
+
+    async def _metrics(self, request, writer):
+        await _send(writer, 200, metrics.prometheus(), 'text/plain; version=0.0.4', keep_alive=request.keep_alive)
+        return request.keep_alive
+
+
+async def serve(service, host, port):
+    server = await service.start(host, port)
+    addresses = ", ".join(f"http://{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in server.sockets)
+    print(f"Serving on {addresses} ({service.workers} workers, {service.max_in_flight} in flight)", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def _named(value):
+    # NAME=PATH, or a bare PATH named after its file
+    name, sep, path = value.partition('=')
+    if not sep:
+        path, name = value, os.path.splitext(os.path.basename(value))[0]
+    return name, path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the watermark engine over HTTP")
+    parser.add_argument('-p', '--preset', action='append', default=[], metavar='[NAME=]PATH',
+                        help="JSON or YAML settings preset, without variants; repeat for more "
+                             "(default: built-in settings)")
+    parser.add_argument('-w', '--watermark', action='append', default=[], metavar='[NAME=]PATH',
+                        help="Watermark/logo image; repeat for more")
+    parser.add_argument('--assets', help="Directory of logos, each named after its file")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(), help="Worker processes")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help="Renders handed to the workers at once (default: two per worker)")
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE,
+                        help="Requests allowed to wait before new ones get a 503")
+    parser.add_argument('--max-body-mb', type=int, default=MAX_BODY_BYTES // (1024 * 1024))
+    parser.add_argument('--body-timeout', type=float, default=BODY_TIMEOUT_SECONDS,
+                        help="Seconds a stalled upload may wait between pieces of its body before a 408")
+    args = parser.parse_args(argv)
+
+    presets = {}
+    for value in args.preset:
+        name, path = _named(value)
+        presets[name] = load_preset(path)
+    if not presets:
+        presets['default'] = dict(DEFAULT_SETTINGS)
+
+    # Imported here rather than at the top: spawned workers re-import this module, and
+    # they should not each load the logo directory
+    from assets import asset_registry
+    if args.assets:
+        asset_registry.load_directory(args.assets)
+    logos = {name: asset_registry.by_name(name).data for name in asset_registry.names()}
+    for value in args.watermark:
+        name, path = _named(value)
+        with open(path, 'rb') as fp:
+            logos[name] = fp.read()
+    if not logos:
+        parser.error("Give at least one logo with --watermark or --assets")
+
+    try:
+        service = WatermarkService(presets, logos, workers=args.workers, max_in_flight=args.max_in_flight,
+                                   max_queue=args.max_queue, max_body=args.max_body_mb * 1024 * 1024,
+                                   body_timeout=args.body_timeout)
+    except ValueError as exc:
+        parser.error(str(exc))
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    with suppress(KeyboardInterrupt):
+        asyncio.run(serve(service, args.host, args.port))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
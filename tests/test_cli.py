@@ -0,0 +1,57 @@
+from PIL import Image
+import io
+import json
+import os
+
+import pytest
+
+from cli import MANIFEST_NAME, main, watermark_directory
+from watermark_engine import DEFAULT_SETTINGS
+
+
+def _encode(image, fmt):
+    buf = io.BytesIO()
+    image.save(buf, fmt)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    src = tmp_path / 'in'
+    src.mkdir()
+    photo = _encode(Image.new('RGB', (160, 120), (30, 90, 160)), 'JPEG')
+    (src / 'a.jpg').write_bytes(photo)
+    (src / 'b.jpg').write_bytes(photo)
+    # Not an image at all, and a JPEG whose header reads fine but whose data stops half-way
+    (src / 'bad.jpg').write_bytes(b'not an image')
+    (src / 'cut.jpg').write_bytes(photo[:len(photo) // 2])
+    logo = tmp_path / 'logo.png'
+    logo.write_bytes(_encode(Image.new('RGBA', (40, 16), (255, 255, 255, 200)), 'PNG'))
+    return src, logo
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_bad_files_are_reported_and_the_rest_written(tmp_path, inputs, workers):
+    src, logo = inputs
+    out = tmp_path / 'out'
+    settings = dict(DEFAULT_SETTINGS, output_format='PNG')
+    summary = watermark_directory([str(src)], str(out), settings, str(logo), workers=workers)
+    assert summary['processed'] == 2
+    assert sorted(reason.split(':')[0] for reason in summary['failed']) == ['bad.jpg', 'cut.jpg']
+    assert sorted(os.listdir(out)) == [MANIFEST_NAME, 'watermarked_a.png', 'watermarked_b.png']
+    assert sorted(json.loads((out / MANIFEST_NAME).read_text())) == ['watermarked_a.png', 'watermarked_b.png']
+
+    # The good files are up to date; the bad ones are tried, and reported, again
+    summary = watermark_directory([str(src)], str(out), settings, str(logo), workers=workers)
+    assert (summary['processed'], summary['skipped'], len(summary['failed'])) == (0, 2, 2)
+
+
+def test_main_exits_non_zero_on_failures(tmp_path, inputs, capsys):
+    src, logo = inputs
+    preset = tmp_path / 'preset.json'
+    preset.write_text(json.dumps({'output_format': 'JPEG'}))
+    status = main([str(src), '-p', str(preset), '-w', str(logo), '-o', str(tmp_path / 'out'), '-j', '1', '-q'])
+    assert status == 1
+    captured = capsys.readouterr()
+    assert "Failed bad.jpg" in captured.err and "Failed cut.jpg" in captured.err
+    assert captured.out.startswith("Processed 2,")
@@ -0,0 +1,98 @@
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+from dataclasses import replace
+
+import pytest
+
+from watermark_engine import DEFAULT_SETTINGS, PreparedWatermarkCache, WatermarkPlan, _transform
+
+CASES = {
+    'plain': {},
+    'shadow': dict(add_shadow=True, shadow_offset_x=-4, shadow_offset_y=6, shadow_blur=5),
+    'effects': dict(add_border=True, border_width=3, border_color="#FF00FF", add_background=True, bg_opacity=40,
+                    adjust_colors=True, brightness=1.2, contrast=0.8, saturation=1.5, add_blur=True, blur_amount=1),
+    'rotated': dict(rotation=25, position="Center", add_shadow=True),
+    'tiled': dict(tile_watermark=True, tile_spacing_x=100, tile_spacing_y=90, tile_rotation=-30, tile_opacity=30,
+                  scale=15, rotation=10),
+}
+
+
+def _logo():
+    # Fully transparent pixels carry colour noise, which only a wrong blend would let through
+    noise = Image.effect_noise((120, 60), 80).convert('RGB')
+    logo = Image.merge('RGBA', (*noise.split(), Image.new('L', noise.size, 0)))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse((5, 5, 115, 55), fill=(200, 30, 30, 220))
+    draw.text((30, 20), "LOGO", fill=(255, 255, 255, 255))
+    return logo
+
+
+def _photo(base):
+    gradient = Image.linear_gradient('L').resize((640, 480))
+    photo = Image.merge('RGB', (gradient, gradient.rotate(90), gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    if base == 'transparent':
+        photo = photo.convert('RGBA')
+        photo.putalpha(gradient.point(lambda value: value // 3))
+    return photo.convert(base) if base == 'L' else photo
+
+
+def _settings(case):
+    settings = dict(DEFAULT_SETTINGS, scale=30, opacity=60, position="Bottom Right", add_shadow=False)
+    settings.update(CASES[case])
+    return settings
+
+
+def _assert_identical(a, b):
+    assert (a.mode, a.size) == (b.mode, b.size)
+    assert a.tobytes() == b.tobytes()
+
+
+def _premultiplied(image):
+    image = image.convert('RGBA')
+    alpha = image.getchannel('A')
+    return Image.merge('RGBA', (*ImageChops.multiply(image.convert('RGB'), Image.merge('RGB', (alpha,) * 3)).split(),
+                                alpha))
+
+
+@pytest.mark.parametrize('base', ['RGB', 'transparent', 'L'])
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_vectorized_matches_pil(case, base):
+    pytest.importorskip('numpy')
+    photo, logo = _photo(base), _logo()
+    expected = WatermarkPlan.compile(_settings(case), logo, cache=None, vectorized=False).apply(photo)
+    for vectorized in (None, True):
+        plan = WatermarkPlan.compile(_settings(case), logo, cache=None, vectorized=vectorized)
+        _assert_identical(plan.apply(photo), expected)
+
+
+@pytest.mark.parametrize('base', ['RGB', 'transparent'])
+def test_strips_match_full_frame(base):
+    photo, logo = _photo(base), _logo()
+    plan = WatermarkPlan.compile(_settings('tiled'), logo, cache=None, vectorized=False)
+    expected = replace(plan, strip_pixels=0).apply(photo)
+    # Bands of one tile period (90 rows), and a last strip shorter than the band
+    _assert_identical(replace(plan, strip_pixels=photo.width * 7).apply(photo), expected)
+
+
+def test_strip_bands_are_not_shared_across_image_sizes():
+    logo = _logo()
+    plan = replace(WatermarkPlan.compile(_settings('tiled'), logo, cache=PreparedWatermarkCache(), vectorized=False),
+                   strip_pixels=200_000)
+    for size in ((1000, 1200), (1000, 2800)):
+        photo = Image.new('RGB', size, (0, 90, 200))
+        _assert_identical(plan.apply(photo), replace(plan, cache=None, strip_pixels=0).apply(photo))
+
+
+@pytest.mark.parametrize('size, angles', [((90, 45), (15,)), ((60, 30), (-30,)), ((200, 100), (33, -30)),
+                                          ((113, 82), (90,)), ((57, 14), (45, 10))])
+def test_fused_transform_matches_chained_resample(size, angles):
+    # One resample instead of a resize and a rotate per angle: the canvas is the same, the
+    # pixels only close. Colour under (near-)transparent pixels is meaningless, so the
+    # comparison is on premultiplied values.
+    logo = _logo()
+    chained = logo.resize(size, Image.Resampling.LANCZOS)
+    for angle in angles:
+        chained = chained.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
+    fused = _transform(logo, size, angles)
+    assert fused.size == chained.size
+    difference = ImageChops.difference(_premultiplied(fused), _premultiplied(chained))
+    assert max(ImageStat.Stat(difference).mean) < 4
@@ -0,0 +1,108 @@
+from PIL import Image, ImageDraw
+from dataclasses import replace
+import io
+
+import pytest
+
+import watermark_engine
+from batch import check_budget
+from watermark_engine import DEFAULT_SETTINGS, ImageTooLarge, WatermarkPlan
+
+LOGO = Image.new('RGBA', (60, 20), (255, 255, 255, 200))
+COLOURS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+
+
+def _frames(mode='RGB'):
+    frames = []
+    for colour in COLOURS:
+        frame = Image.new(mode, (128, 96), colour)
+        ImageDraw.Draw(frame).ellipse((20, 20, 60, 60), fill=(0, 0, 0))
+        frames.append(frame)
+    return frames
+
+
+def _encode(frames, fmt, **options):
+    buf = io.BytesIO()
+    frames[0].save(buf, fmt, save_all=True, append_images=frames[1:], **options)
+    return buf.getvalue()
+
+
+def _watermark(data, **settings):
+    plan = WatermarkPlan.compile(dict(DEFAULT_SETTINGS, **settings), LOGO, cache=None)
+    with Image.open(io.BytesIO(data)) as image:
+        assert plan.keeps_frames(image)
+        return Image.open(io.BytesIO(plan.encode_frames(image)))
+
+
+def _each_frame(image):
+    for index in range(image.n_frames):
+        image.seek(index)
+        image.load()
+        yield image
+
+
+def test_gif_keeps_timing_loop_and_disposal():
+    durations = [40, 80, 120, 160]
+    out = _watermark(_encode(_frames(), 'GIF', duration=durations, loop=3, disposal=[1, 2, 1, 2]))
+    assert out.format == 'GIF' and out.n_frames == 4
+    assert out.info['loop'] == 3
+    assert [(frame.info['duration'], frame.disposal_method) for frame in _each_frame(out)] == \
+        list(zip(durations, [1, 2, 1, 2]))
+
+
+def test_gif_palette_covers_every_frame():
+    # One shared palette cut from the first frame alone would fold these into one colour
+    out = _watermark(_encode(_frames(), 'GIF', duration=100))
+    corners = [frame.convert('RGB').getpixel((2, 2)) for frame in _each_frame(out)]
+    for corner, colour in zip(corners, COLOURS):
+        assert max(abs(a - b) for a, b in zip(corner, colour)) <= 4
+
+
+def test_gif_frame_missing_from_the_palette_sample_gets_its_own(monkeypatch):
+    monkeypatch.setattr(watermark_engine, 'GIF_PALETTE_FRAMES', 2)
+    frames = _frames()
+    frames.insert(1, Image.new('RGB', (128, 96), (255, 0, 255)))
+    out = _watermark(_encode(frames, 'GIF', duration=100))
+    out.seek(1)
+    assert out.convert('RGB').getpixel((2, 2)) == (255, 0, 255)
+
+
+def test_webp_keeps_timing_and_loop():
+    durations = [40, 80, 120, 160]
+    out = _watermark(_encode(_frames('RGBA'), 'WEBP', duration=durations, loop=2, lossless=True))
+    assert out.format == 'WEBP' and out.n_frames == 4
+    assert out.info['loop'] == 2
+    assert [frame.info['duration'] for frame in _each_frame(out)] == durations
+
+
+def test_tiff_pages_round_trip():
+    pages = _frames()
+    pages[2] = pages[2].resize((64, 48))
+    out = _watermark(_encode(pages, 'TIFF', compression='tiff_lzw'))
+    assert out.format == 'TIFF' and out.n_frames == 4
+    for page, source in zip(_each_frame(out), pages):
+        assert page.size == source.size
+        assert page.info['compression'] == 'tiff_lzw'
+        assert page.convert('RGB').getpixel((2, 2)) == source.getpixel((2, 2))
+
+
+def test_keep_frames_off_flattens():
+    plan = WatermarkPlan.compile(dict(DEFAULT_SETTINGS, keep_frames=False), LOGO, cache=None)
+    with Image.open(io.BytesIO(_encode(_frames(), 'GIF', duration=100))) as image:
+        assert not plan.keeps_frames(image)
+
+
+def test_animation_pixel_limit(monkeypatch):
+    # 4 frames of 128x96 are 49,152 pixels together
+    monkeypatch.setattr(watermark_engine, 'MAX_ANIMATION_PIXELS', 40_000)
+    data = _encode(_frames(), 'GIF', duration=100)
+    plan = WatermarkPlan.compile(dict(DEFAULT_SETTINGS), LOGO, cache=None)
+    with Image.open(io.BytesIO(data)) as image:
+        with pytest.raises(ImageTooLarge, match="4 frames"):
+            plan.keeps_frames(image)
+        with pytest.raises(ImageTooLarge):
+            plan.encode_frames(image)
+        # Flattened to the first frame it is an ordinary, small image
+        assert not replace(plan, settings=dict(plan.settings, keep_frames=False)).keeps_frames(image)
+    with pytest.raises(ImageTooLarge):
+        check_budget([('anim.gif', data)], count_frames=True, max_animation_pixels=40_000)
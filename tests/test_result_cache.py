@@ -0,0 +1,112 @@
+from PIL import Image
+import io
+import os
+
+import pytest
+
+from batch import process_batch
+from result_cache import ResultCache, content_digest, result_key
+from watermark_engine import DEFAULT_SETTINGS, parse_variants
+
+ENTRY = 16 + 100  # header + payload of every entry below
+
+
+def _encode(image, fmt):
+    buf = io.BytesIO()
+    image.save(buf, fmt)
+    return buf.getvalue()
+
+
+def test_hit_and_miss(tmp_path):
+    cache = ResultCache(str(tmp_path), 1024)
+    assert cache.get('a') is None
+    cache.put('a', b'x' * 60, b'y' * 40)
+    cache.put('b', b'z' * 100)
+    assert cache.get('a') == (b'x' * 60, b'y' * 40)
+    assert cache.get('b') == (b'z' * 100, None)
+    assert cache.stats() == {'entries': 2, 'bytes': 2 * ENTRY, 'hits': 2, 'misses': 1, 'evictions': 0}
+
+
+def test_evicts_least_recently_used_past_the_byte_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), 2 * ENTRY)
+    cache.put('a', b'a' * 100)
+    cache.put('b', b'b' * 100)
+    cache.get('a')
+    cache.put('c', b'c' * 100)
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    assert sorted(os.listdir(tmp_path)) == ['a.bin', 'c.bin']
+    assert cache.stats()['evictions'] == 1
+    # An entry bigger than the whole budget is not stored at all
+    cache.put('huge', b'h' * 3 * ENTRY)
+    assert cache.get('huge') is None and cache.stats()['entries'] == 2
+
+
+def test_index_is_rebuilt_from_mtimes(tmp_path):
+    cache = ResultCache(str(tmp_path), 10 * ENTRY)
+    for n, key in enumerate('cab'):
+        cache.put(key, key.encode() * 100)
+        os.utime(tmp_path / f'{key}.bin', (1_000_000 + n, 1_000_000 + n))
+    # A new process with a smaller budget drops the oldest files first
+    reopened = ResultCache(str(tmp_path), 2 * ENTRY)
+    assert reopened.stats()['entries'] == 2
+    assert reopened.get('c') is None
+    assert reopened.get('a') == (b'a' * 100, None) and reopened.get('b') == (b'b' * 100, None)
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path), 1024)
+    cache.put('a', b'a' * 100)
+    (tmp_path / 'a.bin').write_bytes(b'short')
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0 and not os.listdir(tmp_path)
+
+
+def test_disabled(tmp_path):
+    cache = ResultCache(str(tmp_path), 0)
+    cache.put('a', b'a')
+    assert not cache.enabled and cache.get('a') is None and not os.listdir(tmp_path)
+
+
+def test_key_covers_settings_watermark_and_thumbnail():
+    keys = {result_key('d', DEFAULT_SETTINGS, 'w'), result_key('d', dict(DEFAULT_SETTINGS, opacity=10), 'w'),
+            result_key('d', DEFAULT_SETTINGS, 'w2'), result_key('d', DEFAULT_SETTINGS, 'w', (64, 64)),
+            result_key('d2', DEFAULT_SETTINGS, 'w')}
+    assert len(keys) == 5
+
+
+@pytest.fixture
+def variant_batch(tmp_path):
+    logo = _encode(Image.new('RGBA', (40, 16), (255, 255, 255, 200)), 'PNG')
+    files = [(f'{n}.png', _encode(Image.new('RGB', (200, 150), (40 * n, 90, 160)), 'PNG')) for n in range(2)]
+    settings = dict(DEFAULT_SETTINGS, output_format='PNG', variants=parse_variants("full, 100:JPEG, 50:WEBP"))
+    cache = ResultCache(str(tmp_path / 'cache'), 64 * 1024 * 1024)
+
+    def run():
+        return process_batch(files, settings, logo, workers=1, cache=cache)
+
+    keys = [result_key(content_digest(data), settings, content_digest(logo)) for _, data in files]
+    return run, cache, keys
+
+
+def test_variants_are_cached_under_their_own_keys(variant_batch):
+    run, cache, keys = variant_batch
+    first = run()
+    assert not any(result.cached for result in first)
+    for key, result in zip(keys, first):
+        assert cache.get(key)[0] == result.variants[0]
+        assert [cache.get(f'{key}-{n}')[0] for n in (1, 2)] == result.variants[1:]
+    second = run()
+    assert all(result.cached for result in second)
+    assert [result.variants for result in second] == [result.variants for result in first]
+
+
+def test_one_evicted_variant_means_rendering_again(variant_batch):
+    run, cache, keys = variant_batch
+    run()
+    os.remove(os.path.join(cache.directory, f'{keys[0]}-2.bin'))
+    results = run()
+    assert [result.cached for result in results] == [False, True]
+    assert len(results[0].variants) == 3
+    # ... and the re-render put the missing variant back
+    assert cache.get(f'{keys[0]}-2') is not None
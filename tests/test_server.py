@@ -0,0 +1,133 @@
+from PIL import Image
+import asyncio
+import http.client
+import io
+import json
+import socket
+import threading
+import time
+import uuid
+import zipfile
+
+import pytest
+
+from server import WatermarkService
+from watermark_engine import DEFAULT_SETTINGS
+
+
+def _encode(image, fmt):
+    buf = io.BytesIO()
+    image.save(buf, fmt)
+    return buf.getvalue()
+
+
+LOGO = _encode(Image.new('RGBA', (40, 16), (255, 255, 255, 200)), 'PNG')
+PHOTO = _encode(Image.new('RGB', (160, 120), (30, 90, 160)), 'JPEG')
+
+
+@pytest.fixture(scope='module')
+def service():
+    # One worker, one render in flight and no queue, so a single stalled upload fills it
+    service = WatermarkService({'default': dict(DEFAULT_SETTINGS, output_format='PNG')}, {'default': LOGO},
+                               workers=1, max_in_flight=1, max_queue=0, body_timeout=2)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(service.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield service, server.sockets[0].getsockname()[1]
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    service.close()
+
+
+def _request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.getheader('Content-Type'), response.read()
+    finally:
+        conn.close()
+
+
+def _multipart(files):
+    boundary = uuid.uuid4().hex
+    body = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n'
+                    for name, data in files)
+    return body + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+
+def test_health(service):
+    _, port = service
+    status, content_type, body = _request(port, 'GET', '/health')
+    assert status == 200 and content_type == 'application/json'
+    health = json.loads(body)
+    assert health['status'] == 'ok' and health['accepting']
+    assert health['presets'] == ['default'] and health['logos'] == ['default']
+
+
+def test_watermark(service):
+    _, port = service
+    status, content_type, body = _request(port, 'POST', '/watermark', PHOTO)
+    assert status == 200 and content_type == 'image/png'
+    assert Image.open(io.BytesIO(body)).size == (160, 120)
+
+
+def test_batch(service):
+    _, port = service
+    body, content_type = _multipart([('a.jpg', PHOTO), ('junk.jpg', b'not an image'), ('b.jpg', PHOTO)])
+    status, response_type, data = _request(port, 'POST', '/batch', body, {'Content-Type': content_type})
+    assert status == 200 and response_type == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.namelist() == ['watermarked_a.png', 'watermarked_b.png', 'errors.json']
+        errors = json.loads(archive.read('errors.json'))
+    assert [(error['file'], error['status']) for error in errors] == [('junk.jpg', 415)]
+
+
+def test_too_large(service):
+    _, port = service
+    # A few kilobytes of PNG that would decode to 400 MP
+    status, _, _ = _request(port, 'POST', '/watermark', _encode(Image.new('1', (20000, 20000)), 'PNG'))
+    assert status == 413
+
+
+def test_unsupported(service):
+    _, port = service
+    status, _, _ = _request(port, 'POST', '/watermark', b'not an image')
+    assert status == 415
+
+
+def test_truncated(service):
+    _, port = service
+    status, _, body = _request(port, 'POST', '/watermark', PHOTO[:len(PHOTO) // 2])
+    assert status == 422, body
+
+
+def test_at_capacity(service):
+    service, port = service
+    # Headers of an upload whose body never comes hold the only slot
+    stalled = socket.create_connection(('127.0.0.1', port))
+    try:
+        stalled.sendall(b'POST /watermark HTTP/1.1\r\nHost: test\r\nContent-Length: 1000\r\n\r\n')
+        deadline = time.monotonic() + 10
+        while service.pending < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        status, _, _ = _request(port, 'POST', '/watermark', PHOTO)
+        assert status == 503
+    finally:
+        stalled.close()
+
+
+def test_stalled_body_times_out(service):
+    service, port = service
+    stalled = socket.create_connection(('127.0.0.1', port), timeout=30)
+    try:
+        stalled.sendall(b'POST /watermark HTTP/1.1\r\nHost: test\r\nContent-Length: 1000\r\n\r\npartial')
+        status_line = stalled.makefile('rb').readline()
+        assert status_line.split()[1] == b'408'
+    finally:
+        stalled.close()
+    # The slot is free again
+    status, _, _ = _request(port, 'POST', '/watermark', PHOTO)
+    assert status == 200
@@ -0,0 +1,100 @@
+from PIL import Image
+import io
+import zipfile
+
+import pytest
+
+from batch import process_batch
+from results_store import ResultsStore
+from watermark_engine import DEFAULT_SETTINGS, WatermarkPlan, output_variants, parse_variants, validate_settings
+
+LOGO = Image.new('RGBA', (40, 16), (255, 255, 255, 200))
+
+
+def _encode(image, fmt):
+    buf = io.BytesIO()
+    image.save(buf, fmt)
+    return buf.getvalue()
+
+
+def test_parse_variants():
+    assert parse_variants("full:JPEG, 2048:webp@85 ,400:JPEG@70, 300") == [
+        {'size': None, 'format': 'JPEG', 'quality': None},
+        {'size': 2048, 'format': 'WEBP', 'quality': 85},
+        {'size': 400, 'format': 'JPEG', 'quality': 70},
+        {'size': 300, 'format': None, 'quality': None},
+    ]
+    assert parse_variants("") == [] and parse_variants(" , ") == []
+
+
+@pytest.mark.parametrize('spec', ["x:JPEG", "400:JPEG@high", "2048.5:PNG"])
+def test_parse_variants_rejects_malformed_items(spec):
+    with pytest.raises(ValueError, match="SIZE:FORMAT@QUALITY"):
+        parse_variants(spec)
+
+
+@pytest.mark.parametrize('spec, message', [
+    ("2048:GIF", "Unknown variant format"),
+    ("full:JPEG, full:jpeg", "same size and format"),
+    # No format falls back to output_format (PNG), so these two collide as well
+    ("400, 400:PNG", "same size and format"),
+])
+def test_validate_settings_rejects_bad_variants(spec, message):
+    with pytest.raises(ValueError, match=message):
+        validate_settings(dict(DEFAULT_SETTINGS, variants=spec))
+
+
+@pytest.mark.parametrize('spec', ["0:JPEG", "400:JPEG@0", "400:JPEG@101"])
+def test_validate_settings_rejects_out_of_range_variants(spec):
+    with pytest.raises(ValueError):
+        validate_settings(dict(DEFAULT_SETTINGS, variants=spec))
+
+
+def test_preset_may_list_variants_as_dicts():
+    # What a JSON/YAML preset holds; the same as the string form
+    listed = [{'size': None, 'format': 'JPEG'}, {'size': 400, 'format': 'WEBP', 'quality': 80}]
+    settings = dict(DEFAULT_SETTINGS, variants=listed)
+    validate_settings(settings)
+    assert output_variants(settings) == output_variants(dict(DEFAULT_SETTINGS, variants="full:JPEG, 400:WEBP@80"))
+    jpeg, webp = output_variants(settings)
+    assert (jpeg.size, jpeg.output_format, jpeg.save_options['quality']) == (None, 'JPEG', 95)
+    assert (webp.size, webp.output_format, webp.save_options['quality']) == (400, 'WEBP', 80)
+
+
+def test_variant_file_names():
+    variants = output_variants(dict(DEFAULT_SETTINGS, output_format='PNG', variants="full, full:JPEG, 2048:WEBP"))
+    assert [variant.filename("photo.final.png", "wm_") for variant in variants] == [
+        "wm_photo.final.png", "wm_photo.final.jpeg", "wm_photo.final_2048px.webp"]
+    assert [variant.mime_type for variant in variants] == ["image/png", "image/jpeg", "image/webp"]
+
+
+def test_variant_batch_contents():
+    photo = _encode(Image.new('RGB', (600, 400), (30, 90, 160)), 'PNG')
+    files = [('a.png', photo), ('b.jpg', _encode(Image.new('RGB', (300, 500), (200, 50, 20)), 'JPEG')),
+             ('copy.png', photo)]
+    settings = dict(DEFAULT_SETTINGS, output_format='PNG', variants="full:JPEG, 200:WEBP@80, 1000:PNG")
+    plan = WatermarkPlan.compile(settings, LOGO, cache=None)
+    store = ResultsStore()
+    batch = store.new_batch()
+    logo = _encode(LOGO, 'PNG')
+    for idx, result in enumerate(process_batch(files, settings, logo, workers=1, thumbnail_size=(64, 64))):
+        store.add_result(batch, files[idx][0], result, plan, "wm_")
+    batch.finish()
+
+    names = ["wm_a.jpeg", "wm_a_200px.webp", "wm_a_1000px.png", "wm_b.jpeg", "wm_b_200px.webp", "wm_b_1000px.png",
+             "wm_copy.jpeg", "wm_copy_200px.webp", "wm_copy_1000px.png"]
+    assert [entry.name for entry in batch.entries] == names
+    # The duplicate upload shares the stored outputs of the first one
+    assert [entry.shared for entry in batch.entries] == [False] * 6 + [True] * 3
+    with zipfile.ZipFile(io.BytesIO(batch.archive.getvalue())) as archive:
+        assert archive.namelist() == names
+        sizes = {}
+        for name in names:
+            with Image.open(io.BytesIO(archive.read(name))) as image:
+                sizes[name] = (image.format, image.size)
+    assert sizes["wm_a.jpeg"] == ('JPEG', (600, 400))
+    assert sizes["wm_a_200px.webp"] == ('WEBP', (200, 133))
+    # Never upscaled past the image itself
+    assert sizes["wm_a_1000px.png"] == ('PNG', (600, 400))
+    assert sizes["wm_b_200px.webp"] == ('WEBP', (120, 200))
+    assert [entry.mime for entry in batch.entries[:3]] == ["image/jpeg", "image/webp", "image/png"]
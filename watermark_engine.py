@@ -0,0 +1,1111 @@
+from PIL import Image, ImageChops, ImageDraw, ImageEnhance, ImageFilter, ImageStat, TiffImagePlugin
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from types import MappingProxyType
+import contextvars
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+import time
+
+from instrumentation import stage
+
+try:
+    import numpy_effects
+except ImportError:  # NumPy is optional; the PIL effect chain is used without it
+    numpy_effects = None
+
+
+def hex_to_rgba(hex_color, alpha=255):
+    hex_color = hex_color.lstrip('#')
+    rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    return rgb + (alpha,)
+
+def get_position_coords(img_width, img_height, wm_width, wm_height, position, margin_x=30, margin_y=30):
+    positions = {
+        "Bottom Center (2/3)": ((img_width - wm_width) // 2, int(img_height * 2/3) - wm_height // 2),
+        "Bottom Right": (img_width - wm_width - margin_x, img_height - wm_height - margin_y),
+        "Bottom Left": (margin_x, img_height - wm_height - margin_y),
+        "Top Right": (img_width - wm_width - margin_x, margin_y),
+        "Top Left": (margin_x, margin_y),
+        "Center": ((img_width - wm_width) // 2, (img_height - wm_height) // 2),
+        "Bottom Center": ((img_width - wm_width) // 2, img_height - wm_height - margin_y),
+        "Top Center": ((img_width - wm_width) // 2, margin_y),
+        "Left Center": (margin_x, (img_height - wm_height) // 2),
+        "Right Center": (img_width - wm_width - margin_x, (img_height - wm_height) // 2)
+    }
+    return positions.get(position, positions["Bottom Center (2/3)"])
+
+def get_watermark_size(img_width, img_height, wm_width, wm_height, settings):
+    if settings.get('scale_mode') == "Percentage of Image":
+        new_width = int(img_width * settings['scale'] / 100)
+        if settings.get('maintain_aspect', True):
+            aspect_ratio = wm_height / wm_width
+            new_height = int(new_width * aspect_ratio)
+        else:
+            new_height = int(img_height * settings['scale'] / 100)
+    elif settings.get('scale_mode') == "Fixed Width (px)":
+        new_width = settings['fixed_width']
+        aspect_ratio = wm_height / wm_width
+        new_height = int(new_width * aspect_ratio)
+    elif settings.get('scale_mode') == "Fixed Height (px)":
+        new_height = settings['fixed_height']
+        aspect_ratio = wm_width / wm_height
+        new_width = int(new_height * aspect_ratio)
+    else:  # Custom Size
+        new_width = settings['custom_width']
+        new_height = settings['custom_height']
+    return new_width, new_height
+
+def watermark_digest(watermark_img):
+    # Content hash of the watermark pixels, used as part of the prepared-layer cache key
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{watermark_img.mode}:{watermark_img.size}".encode())
+    palette = watermark_img.getpalette() if watermark_img.mode == 'P' else None
+    if palette:
+        h.update(bytes(palette))
+    h.update(watermark_img.tobytes())
+    return h.hexdigest()
+
+def settings_digest(settings):
+    # Stable hash of the full settings dict (key order does not matter)
+    encoded = json.dumps(dict(settings), sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+def output_filename(filename, prefix, extension):
+    name = filename.rsplit('.', 1)[0]
+    return f"{prefix}{name}.{extension}"
+
+def effective_settings(settings):
+    # Only the settings that change the prepared watermark layer; toggled-off effects
+    # are left out so their leftover slider values don't split the cache.
+    key = [('opacity', settings['opacity']), ('rotation', settings.get('rotation', 0))]
+    if settings.get('adjust_colors', False):
+        key += [('brightness', settings.get('brightness', 1.0)),
+                ('contrast', settings.get('contrast', 1.0)),
+                ('saturation', settings.get('saturation', 1.0))]
+    if settings.get('add_blur', False):
+        key.append(('blur_amount', settings.get('blur_amount', 2)))
+    if settings.get('tile_watermark', False):
+        key += [('tile_rotation', settings.get('tile_rotation', 0)),
+                ('tile_opacity', settings.get('tile_opacity', 15))]
+        return tuple(key)
+    if settings.get('add_background', False):
+        key += [('bg_color', settings['bg_color']), ('bg_opacity', settings['bg_opacity']),
+                ('bg_padding', settings.get('bg_padding', 15))]
+    if settings.get('add_border', False):
+        key += [('border_width', settings.get('border_width', 3)), ('border_color', settings['border_color'])]
+    if settings.get('add_shadow', False):
+        key += [('shadow_offset_x', settings.get('shadow_offset_x', 3)),
+                ('shadow_offset_y', settings.get('shadow_offset_y', 3)),
+                ('shadow_blur', settings.get('shadow_blur', 5)),
+                ('shadow_opacity', settings.get('shadow_opacity', 50))]
+    return tuple(key)
+
+
+class PreparedWatermarkCache:
+    # Bounded LRU of fully prepared watermark layers. Entries are shared between
+    # callers and must be treated as read-only.
+
+    def __init__(self, max_entries=32, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        size = self._sizeof(image)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizeof(self._entries.pop(key))
+            self._entries[key] = image
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._sizeof(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Process-wide cache shared by every session
+prepared_cache = PreparedWatermarkCache()
+
+SCALE_MODES = ("Percentage of Image", "Fixed Width (px)", "Fixed Height (px)", "Custom Size")
+POSITION_PRESETS = (
+    "Bottom Center (2/3)", "Bottom Right", "Bottom Left", "Top Right", "Top Left", "Center",
+    "Bottom Center", "Top Center", "Left Center", "Right Center", "Custom Position",
+)
+OUTPUT_FORMATS = ("PNG", "JPEG", "WEBP")
+
+# Pillow save() options per encoder preset and format. "balanced" is Pillow's defaults;
+# individual png_/jpeg_/webp_ settings override whatever the preset picks. libjpeg's
+# defaults are already its fastest path (4:2:0, no Huffman pass), so for JPEG "fastest"
+# is the same as "balanced"; same_as_balanced() lets the UI say so.
+ENCODER_PRESETS = {
+    "fastest": {'PNG': {'compress_level': 1}, 'JPEG': {}, 'WEBP': {'method': 0}},
+    "balanced": {'PNG': {'compress_level': 6}, 'JPEG': {}, 'WEBP': {'method': 4}},
+    "smallest": {'PNG': {'compress_level': 9, 'optimize': True}, 'JPEG': {'optimize': True, 'progressive': True},
+                 'WEBP': {'method': 6}},
+}
+JPEG_SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+_ENCODER_OVERRIDES = {
+    'PNG': (('png_compress_level', 'compress_level'), ('png_optimize', 'optimize')),
+    'JPEG': (('jpeg_subsampling', 'subsampling'), ('jpeg_optimize', 'optimize'),
+             ('jpeg_progressive', 'progressive')),
+    'WEBP': (('webp_method', 'method'), ('webp_lossless', 'lossless')),
+}
+
+# Decode budgets in megapixels; 0 disables a limit. Tiled layers for images above
+# STRIP_PIXELS are composited one horizontal strip at a time.
+MAX_IMAGE_PIXELS = int(float(os.environ.get('WATERMARK_MAX_IMAGE_MP', 250)) * 1_000_000)
+MAX_WATERMARK_PIXELS = int(float(os.environ.get('WATERMARK_MAX_LOGO_MP', 25)) * 1_000_000)
+MAX_BATCH_PIXELS = int(float(os.environ.get('WATERMARK_MAX_BATCH_MP', 20_000)) * 1_000_000)
+# Frames x pixels of one animation or multi-page file kept whole; its frames are all held
+# until the encoder writes them (GIF at 1 byte/px, WEBP as RGBA)
+MAX_ANIMATION_PIXELS = int(float(os.environ.get('WATERMARK_MAX_ANIMATION_MP', 1_000)) * 1_000_000)
+STRIP_PIXELS = int(float(os.environ.get('WATERMARK_STRIP_MP', 16)) * 1_000_000)
+
+# Animated and multi-page inputs keep every frame, in their own format, when keep_frames is on.
+# Frames of one image are blended on FRAME_THREADS threads; Pillow releases the GIL meanwhile.
+MULTI_FRAME_FORMATS = ('GIF', 'WEBP', 'TIFF')
+FRAME_THREADS = int(os.environ.get('WATERMARK_FRAME_THREADS', min(4, os.cpu_count() or 1)))
+_TIFF_LOSSLESS = ('raw', 'packbits', 'tiff_lzw', 'tiff_adobe_deflate')
+# A GIF's shared palette is cut from this many watermarked frames, spread over the animation.
+# Frames it maps worse than _GIF_PALETTE_RMS (per-channel RMS) get a local palette instead.
+GIF_PALETTE_FRAMES = 8
+_GIF_PALETTE_EDGE = 256
+_GIF_PALETTE_RMS = 12
+
+# Pillow's own bomb check would refuse images between its default and our limit at open().
+# Every decode of uploaded bytes - images and logos alike - goes through open_image, whose
+# header check against the limits above is the one that applies.
+if MAX_IMAGE_PIXELS and Image.MAX_IMAGE_PIXELS and MAX_IMAGE_PIXELS > Image.MAX_IMAGE_PIXELS:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Settings the Streamlit sidebar starts with; presets only need to override what differs
+DEFAULT_SETTINGS = {
+    'scale_mode': "Percentage of Image",
+    'scale': 80,
+    'fixed_width': None,
+    'fixed_height': None,
+    'custom_width': None,
+    'custom_height': None,
+    'position': "Bottom Center (2/3)",
+    'custom_x': None,
+    'custom_y': None,
+    'margin_x': 30,
+    'margin_y': 30,
+    'opacity': 60,
+    'rotation': 0,
+    'add_blur': False,
+    'blur_amount': 0,
+    'add_shadow': True,
+    'shadow_offset_x': 3,
+    'shadow_offset_y': 3,
+    'shadow_blur': 5,
+    'shadow_opacity': 50,
+    'add_border': False,
+    'border_width': 0,
+    'border_color': "#FFFFFF",
+    'add_background': False,
+    'bg_color': "#000000",
+    'bg_opacity': 30,
+    'bg_padding': 15,
+    'tile_watermark': False,
+    'tile_spacing_x': 200,
+    'tile_spacing_y': 200,
+    'tile_rotation': 0,
+    'tile_opacity': 15,
+    'adjust_colors': False,
+    'brightness': 1.0,
+    'contrast': 1.0,
+    'saturation': 1.0,
+    'maintain_aspect': True,
+    'output_format': "PNG",
+    'jpeg_quality': 95,
+    'encoder_preset': "balanced",
+    'png_compress_level': None,
+    'png_optimize': None,
+    'jpeg_subsampling': None,
+    'jpeg_optimize': None,
+    'jpeg_progressive': None,
+    'webp_method': None,
+    'webp_lossless': None,
+    # Extra deliverables cut from the one watermarked image; empty means a single output.
+    # Only the app exports them; the CLI and the HTTP service refuse such presets.
+    'variants': None,
+    # Animated GIF/WEBP and multi-page TIFF stay multi-frame; off flattens them to the first frame
+    'keep_frames': True,
+}
+
+# Settings measured in pixels, which have to shrink with the image for reduced-size previews
+PIXEL_SETTINGS = ('fixed_width', 'fixed_height', 'custom_width', 'custom_height', 'margin_x', 'margin_y',
+                  'shadow_offset_x', 'shadow_offset_y', 'shadow_blur', 'border_width', 'bg_padding',
+                  'tile_spacing_x', 'tile_spacing_y')
+_POSITIVE_PIXEL_SETTINGS = ('fixed_width', 'fixed_height', 'custom_width', 'custom_height',
+                            'border_width', 'tile_spacing_x', 'tile_spacing_y')
+
+# Settings each scale mode needs before a plan can be compiled
+_SCALE_KEYS = {
+    "Percentage of Image": ('scale',),
+    "Fixed Width (px)": ('fixed_width',),
+    "Fixed Height (px)": ('fixed_height',),
+    "Custom Size": ('custom_width', 'custom_height'),
+}
+
+
+def scale_settings(settings, factor):
+    # Settings for an image resized by `factor`, so the watermark keeps the same relative geometry
+    scaled = dict(settings)
+    for key in PIXEL_SETTINGS:
+        value = scaled.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = round(value * factor)
+            if key in _POSITIVE_PIXEL_SETTINGS and settings[key] > 0:
+                value = max(1, value)
+            scaled[key] = value
+    if isinstance(scaled.get('blur_amount'), (int, float)):
+        scaled['blur_amount'] = scaled['blur_amount'] * factor
+    return scaled
+
+def parse_variants(spec):
+    # "full:JPEG, 2048:WEBP@85, 400:JPEG" -> [{'size', 'format', 'quality'}, ...]. size is the
+    # longest edge in pixels ("full" keeps the image size); a missing format means the
+    # output_format setting and a missing quality the format's usual one.
+    variants = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        size, _, rest = item.partition(':')
+        output_format, _, quality = rest.partition('@')
+        try:
+            variants.append({
+                'size': None if size.strip().lower() in ("full", "") else int(size),
+                'format': output_format.strip().upper() or None,
+                'quality': int(quality) if quality.strip() else None,
+            })
+        except ValueError:
+            raise ValueError(f"Can't read output variant {item!r}; expected SIZE:FORMAT@QUALITY") from None
+    return variants
+
+
+@dataclass(frozen=True)
+class OutputVariant:
+    size: int
+    output_format: str
+    save_options: Mapping
+
+    @property
+    def suffix(self):
+        return f"_{self.size}px" if self.size else ""
+
+    @property
+    def extension(self):
+        return self.output_format.lower()
+
+    @property
+    def mime_type(self):
+        return f"image/{self.extension}"
+
+    def filename(self, filename, prefix):
+        # photo.png -> watermarked_photo.jpeg, watermarked_photo_2048px.webp, ...
+        name = filename.rsplit('.', 1)[0]
+        return f"{prefix}{name}{self.suffix}.{self.extension}"
+
+
+def output_variants(settings):
+    # Resolved OutputVariants of a settings dict, in the order they were listed
+    variants = settings.get('variants') or ()
+    if isinstance(variants, str):
+        variants = parse_variants(variants)
+    resolved = []
+    for variant in variants:
+        overrides = {'output_format': variant.get('format') or settings.get('output_format', 'PNG')}
+        if variant.get('quality') is not None:
+            overrides['jpeg_quality'] = variant['quality']
+        output_format, options = _resolve_encoder(dict(settings, **overrides))
+        if variant.get('quality') is not None and output_format != 'PNG':
+            options['quality'] = variant['quality']
+        resolved.append(OutputVariant(variant.get('size'), output_format, MappingProxyType(options)))
+    return tuple(resolved)
+
+
+def frame_count(image):
+    # Frames (or pages) that keep_frames would carry over; reading it only parses headers
+    if image.format not in MULTI_FRAME_FORMATS:
+        return 1
+    return getattr(image, 'n_frames', 1)
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def check_dimensions(size, max_pixels=MAX_IMAGE_PIXELS, name="image"):
+    # Raises before anything is decoded; only the header has to be read to know the size
+    width, height = size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(f"{name} is {width}x{height} ({width * height / 1e6:.1f} MP), "
+                            f"over the {max_pixels / 1e6:g} MP limit per image")
+    return size
+
+def check_frames(image, max_pixels=MAX_ANIMATION_PIXELS, name=None):
+    # check_dimensions for every frame of an animation together; header-only as well
+    frames = frame_count(image)
+    total = image.width * image.height * frames
+    if frames > 1 and max_pixels and total > max_pixels:
+        name = name or getattr(image, 'filename', None) or "image"
+        raise ImageTooLarge(f"{name} has {frames} frames of {image.width}x{image.height} ({total / 1e6:.1f} MP), "
+                            f"over the {max_pixels / 1e6:g} MP limit per animation")
+    return frames
+
+def open_image(source, max_pixels=MAX_IMAGE_PIXELS, name=None):
+    # Image.open only parses the header, so oversized inputs and decompression bombs are
+    # refused before their pixel data is touched
+    name = name or getattr(source, 'name', None) or "image"
+    try:
+        image = Image.open(source)
+    except Image.DecompressionBombError as exc:
+        raise ImageTooLarge(f"{name}: {exc}") from None
+    try:
+        check_dimensions(image.size, max_pixels, name)
+    except ImageTooLarge:
+        image.close()
+        raise
+    return image
+
+def open_watermark(data, name="watermark"):
+    # Logos are decoded in full and kept around, so they get a budget of their own
+    image = open_image(io.BytesIO(data), MAX_WATERMARK_PIXELS, name)
+    image.load()
+    return image
+
+def load_preview(source, max_size=800):
+    # Decode a reduced copy for previews: JPEG scales in the DCT via draft(), other formats
+    # are decoded and then shrunk by an integer factor with reduce(). Returns the image and
+    # its scale relative to the full-size original.
+    image = open_image(source)
+    full_width = image.width
+    if image.format == 'JPEG':
+        image.draft(image.mode, (max_size, max_size))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert(_working_mode(image))
+    factor = max(image.width, image.height) // max_size
+    if factor > 1:
+        image = image.reduce(factor)
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
+    return image, image.width / full_width
+
+def _check_number(settings, key, low=None, high=None):
+    value = settings.get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{key} must be a number, got {value!r}")
+    if low is not None and value < low:
+        raise ValueError(f"{key} must be at least {low}, got {value!r}")
+    if high is not None and value > high:
+        raise ValueError(f"{key} must be at most {high}, got {value!r}")
+
+def _check_color(settings, key):
+    value = settings.get(key)
+    try:
+        hex_to_rgba(value)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"{key} must be a #RRGGBB colour, got {value!r}") from None
+
+def validate_settings(settings):
+    scale_mode = settings.get('scale_mode')
+    if scale_mode not in SCALE_MODES:
+        raise ValueError(f"Unknown scale_mode {scale_mode!r}")
+    for key in _SCALE_KEYS[scale_mode]:
+        _check_number(settings, key, low=1)
+    _check_number(settings, 'opacity', 0, 100)
+    if settings.get('output_format', 'PNG') not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format {settings.get('output_format')!r}")
+    if settings.get('output_format') == 'JPEG':
+        _check_number(settings, 'jpeg_quality', 1, 100)
+    if settings.get('encoder_preset', "balanced") not in ENCODER_PRESETS:
+        raise ValueError(f"Unknown encoder_preset {settings.get('encoder_preset')!r}")
+    if settings.get('png_compress_level') is not None:
+        _check_number(settings, 'png_compress_level', 0, 9)
+    if settings.get('webp_method') is not None:
+        _check_number(settings, 'webp_method', 0, 6)
+    if settings.get('jpeg_subsampling') not in (None,) + JPEG_SUBSAMPLING:
+        raise ValueError(f"Unknown jpeg_subsampling {settings.get('jpeg_subsampling')!r}")
+    variants = settings.get('variants') or ()
+    for variant in parse_variants(variants) if isinstance(variants, str) else variants:
+        if variant.get('size') is not None:
+            _check_number(variant, 'size', low=1)
+        if variant.get('format') not in (None,) + OUTPUT_FORMATS:
+            raise ValueError(f"Unknown variant format {variant.get('format')!r}")
+        if variant.get('quality') is not None:
+            _check_number(variant, 'quality', 1, 100)
+    targets = [(variant.size, variant.output_format) for variant in output_variants(settings)]
+    if len(set(targets)) != len(targets):
+        raise ValueError("Two output variants have the same size and format, so they would share a file name")
+    if settings.get('tile_watermark', False):
+        _check_number(settings, 'tile_spacing_x', low=1)
+        _check_number(settings, 'tile_spacing_y', low=1)
+        return
+    position = settings.get('position')
+    if position not in POSITION_PRESETS:
+        raise ValueError(f"Unknown position {position!r}")
+    if position == "Custom Position":
+        _check_number(settings, 'custom_x', 0, 100)
+        _check_number(settings, 'custom_y', 0, 100)
+    if settings.get('add_background', False):
+        _check_color(settings, 'bg_color')
+        _check_number(settings, 'bg_opacity', 0, 100)
+    if settings.get('add_border', False):
+        _check_color(settings, 'border_color')
+
+# Effect steps. Each takes the watermark layer and the settings and returns a new layer.
+
+def _adjust_colors(wm, settings):
+    wm = ImageEnhance.Brightness(wm).enhance(settings.get('brightness', 1.0))
+    wm = ImageEnhance.Contrast(wm).enhance(settings.get('contrast', 1.0))
+    return ImageEnhance.Color(wm).enhance(settings.get('saturation', 1.0))
+
+def _blur(wm, settings):
+    return wm.filter(ImageFilter.GaussianBlur(radius=settings.get('blur_amount', 2)))
+
+def _scale_alpha(wm, factor):
+    alpha = wm.split()[3]
+    alpha = ImageEnhance.Brightness(alpha).enhance(factor)
+    wm.putalpha(alpha)
+    return wm
+
+def _opacity(wm, settings):
+    return _scale_alpha(wm, settings['opacity'] / 100)
+
+def _tile_opacity(wm, settings):
+    return _scale_alpha(wm, settings.get('tile_opacity', 15) / 100)
+
+def _background(wm, settings):
+    padding = settings.get('bg_padding', 15)
+    bg_width = wm.width + padding * 2
+    bg_height = wm.height + padding * 2
+    bg_img = Image.new('RGBA', (bg_width, bg_height), (0, 0, 0, 0))
+    bg_draw = ImageDraw.Draw(bg_img)
+    bg_color = hex_to_rgba(settings['bg_color'], int(255 * settings['bg_opacity'] / 100))
+    bg_draw.rectangle([0, 0, bg_width, bg_height], fill=bg_color)
+
+    # Paste watermark on background
+    bg_img.paste(wm, (padding, padding), wm)
+    return bg_img
+
+def _border(wm, settings):
+    border_width = settings.get('border_width', 3)
+    bordered = Image.new('RGBA', (wm.width + border_width*2, wm.height + border_width*2), (0, 0, 0, 0))
+    border_draw = ImageDraw.Draw(bordered)
+    border_color = hex_to_rgba(settings['border_color'], 255)
+    border_draw.rectangle([0, 0, bordered.width, bordered.height], outline=border_color, width=border_width)
+    bordered.paste(wm, (border_width, border_width), wm)
+    return bordered
+
+def _shadow(wm, settings):
+    shadow_offset_x = settings.get('shadow_offset_x', 3)
+    shadow_offset_y = settings.get('shadow_offset_y', 3)
+    shadow_blur = settings.get('shadow_blur', 5)
+    shadow_opacity = settings.get('shadow_opacity', 50)
+
+    # Create shadow layer
+    shadow = Image.new('RGBA', (wm.width + abs(shadow_offset_x)*2 + shadow_blur*2,
+                               wm.height + abs(shadow_offset_y)*2 + shadow_blur*2), (0, 0, 0, 0))
+    shadow_draw = ImageDraw.Draw(shadow)
+    shadow_color = (0, 0, 0, int(255 * shadow_opacity / 100))
+
+    # Draw shadow rectangle
+    shadow_pos = (shadow_blur + abs(min(0, shadow_offset_x)),
+                 shadow_blur + abs(min(0, shadow_offset_y)))
+    shadow_draw.rectangle([shadow_pos[0], shadow_pos[1],
+                          shadow_pos[0] + wm.width, shadow_pos[1] + wm.height],
+                         fill=shadow_color)
+
+    # Blur shadow
+    shadow = shadow.filter(ImageFilter.GaussianBlur(radius=shadow_blur))
+
+    # Paste watermark on shadow
+    wm_pos = (shadow_blur + abs(min(0, shadow_offset_x)) - shadow_offset_x,
+             shadow_blur + abs(min(0, shadow_offset_y)) - shadow_offset_y)
+    shadow.paste(wm, wm_pos, wm)
+    return shadow
+
+# NumPy steps that beat PIL's C loops on typical watermark sizes: in-place alpha scaling and an
+# alpha-only shadow blur. The other NumPy steps are exact but slower, so they only run when a
+# plan asks for the whole chain with vectorized=True.
+_FASTER_VECTORIZED = ('opacity', 'tile_opacity', 'shadow')
+
+def _pick_effect(step, name, vectorized):
+    if numpy_effects is None or vectorized is False:
+        return step
+    if vectorized is None and name not in _FASTER_VECTORIZED:
+        return step
+    return getattr(numpy_effects, name)
+
+def _resolve_effects(settings, vectorized=False):
+    # Steps before the resize, steps at the resized size before any rotation, and steps after
+    # the rotations, in the order they are applied. vectorized=None swaps in the NumPy steps
+    # that are faster, True swaps in all of them.
+    pre = (_pick_effect(_adjust_colors, 'adjust_colors', vectorized),) if settings.get('adjust_colors', False) else ()
+    resized = (_blur,) if settings.get('add_blur', False) else ()
+    post = [_pick_effect(_opacity, 'opacity', vectorized)]
+    if settings.get('tile_watermark', False):
+        post.append(_pick_effect(_tile_opacity, 'tile_opacity', vectorized))
+    else:
+        if settings.get('add_background', False):
+            post.append(_pick_effect(_background, 'background', vectorized))
+        if settings.get('add_border', False):
+            post.append(_pick_effect(_border, 'border', vectorized))
+        if settings.get('add_shadow', False):
+            post.append(_pick_effect(_shadow, 'shadow', vectorized))
+    return pre, resized, tuple(post)
+
+def _resolve_rotations(settings):
+    # Rotations applied one after the other, each expanding the canvas to fit
+    angles = [settings.get('rotation', 0)]
+    if settings.get('tile_watermark', False):
+        angles.append(settings.get('tile_rotation', 0))
+    return tuple(angle for angle in angles if angle % 360 != 0)
+
+def _rotation_matrix(size, angle):
+    # Inverse mapping and expanded size of Image.rotate(angle, expand=True), worked out the
+    # way Pillow does it so the fused transform lands on exactly the same canvas
+    w, h = size
+    radians = -math.radians(angle)
+    a, b = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    d, e = -b, a
+    c = a * -w / 2 + b * -h / 2 + w / 2
+    f = d * -w / 2 + e * -h / 2 + h / 2
+    if angle % 90 == 0:
+        # Pillow transposes quarter turns instead, which keeps the size exact
+        nw, nh = (h, w) if angle % 180 else (w, h)
+    else:
+        xx, yy = zip(*((a * x + b * y + c, d * x + e * y + f) for x, y in ((0, 0), (w, 0), (w, h), (0, h))))
+        nw = math.ceil(max(xx)) - math.floor(min(xx))
+        nh = math.ceil(max(yy)) - math.floor(min(yy))
+    ox, oy = -(nw - w) / 2, -(nh - h) / 2
+    return (nw, nh), (a, b, a * ox + b * oy + c, d, e, d * ox + e * oy + f)
+
+def _compose(outer, inner):
+    # Affine map of applying `outer` first, then `inner` (both output -> input, 2x3 row-major)
+    a1, b1, c1, d1, e1, f1 = outer
+    a2, b2, c2, d2, e2, f2 = inner
+    return (a2 * a1 + b2 * d1, a2 * b1 + b2 * e1, a2 * c1 + b2 * f1 + c2,
+            d2 * a1 + e2 * d1, d2 * b1 + e2 * e1, d2 * c1 + e2 * f1 + f2)
+
+def _transform(wm, target_size, angles):
+    # Resize to target_size and apply every rotation in one resample. Pillow's affine
+    # transform samples without antialiasing, so a large shrink is first taken down with an
+    # integer box reduce and the transform covers the last factor of less than two.
+    if not angles:
+        return wm if wm.size == tuple(target_size) else wm.resize(target_size, Image.Resampling.LANCZOS)
+    factor = min(wm.width // target_size[0], wm.height // target_size[1])
+    if factor >= 2:
+        wm = wm.reduce(factor)
+    matrix = (wm.width / target_size[0], 0, 0, 0, wm.height / target_size[1], 0)
+    size = tuple(target_size)
+    for angle in angles:
+        size, rotation = _rotation_matrix(size, angle)
+        matrix = _compose(rotation, matrix)
+    return wm.transform(size, Image.Transform.AFFINE, matrix, Image.Resampling.BICUBIC)
+
+def _run_effect(effect, wm, settings):
+    # Hand each step the representation it works on, converting only where PIL and NumPy
+    # steps meet, so consecutive NumPy steps share one array
+    if getattr(effect, 'vectorized', False):
+        if isinstance(wm, Image.Image):
+            wm = numpy_effects.to_array(wm)
+    elif not isinstance(wm, Image.Image):
+        wm = numpy_effects.to_image(wm)
+    return effect(wm, settings)
+
+def _as_image(wm):
+    return wm if isinstance(wm, Image.Image) else numpy_effects.to_image(wm)
+
+def _resolve_position(settings):
+    if settings.get('tile_watermark', False):
+        return None
+    if settings['position'] == "Custom Position":
+        custom_x, custom_y = settings['custom_x'], settings['custom_y']
+
+        def position(img_width, img_height, wm_width, wm_height):
+            return (int(img_width * custom_x / 100) - wm_width // 2,
+                    int(img_height * custom_y / 100) - wm_height // 2)
+    else:
+        preset = settings['position']
+        margin_x, margin_y = settings.get('margin_x', 30), settings.get('margin_y', 30)
+
+        def position(img_width, img_height, wm_width, wm_height):
+            return get_position_coords(img_width, img_height, wm_width, wm_height, preset, margin_x, margin_y)
+    return position
+
+def _resolve_encoder(settings):
+    output_format = settings.get('output_format', 'PNG')
+    options = dict(ENCODER_PRESETS[settings.get('encoder_preset', "balanced")][output_format])
+    for key, option in _ENCODER_OVERRIDES[output_format]:
+        if settings.get(key) is not None:
+            options[option] = settings[key]
+    if output_format == 'JPEG':
+        options['quality'] = settings.get('jpeg_quality', 95)
+    elif output_format == 'WEBP':
+        options['quality'] = 95
+    return output_format, options
+
+def same_as_balanced(preset, output_format):
+    return preset != "balanced" and ENCODER_PRESETS[preset][output_format] == ENCODER_PRESETS["balanced"][output_format]
+
+def compare_encoders(image, settings, presets=tuple(ENCODER_PRESETS)):
+    # Encode one watermarked image with each preset; [{'preset', 'seconds', 'bytes', 'same_as_balanced'}]
+    output_format = settings.get('output_format', 'PNG')
+    plain = {key: None for key, _ in _ENCODER_OVERRIDES[output_format]}
+    # A stored result can be a palette GIF frame; encode the mode apply() would hand over
+    mode = 'RGB' if output_format == 'JPEG' else _working_mode(image)
+    if image.mode != mode:
+        image = image.convert(mode)
+    report = []
+    for preset in presets:
+        output_format, options = _resolve_encoder(dict(settings, encoder_preset=preset, **plain))
+        buf = io.BytesIO()
+        start = time.perf_counter()
+        image.save(buf, format=output_format, **options)
+        report.append({'preset': preset, 'seconds': time.perf_counter() - start, 'bytes': buf.tell(),
+                       'same_as_balanced': same_as_balanced(preset, output_format)})
+    return report
+
+
+def _to_palette(frame, palette, max_rms=_GIF_PALETTE_RMS):
+    # Map a frame onto the animation's shared palette. No dithering, so areas that don't
+    # change between frames don't shimmer; index 255 is kept free for transparency.
+    rgb = frame if frame.mode == 'RGB' else frame.convert('RGB')
+    indexed = rgb.quantize(palette=palette, dither=Image.Dither.NONE)
+    if max_rms is not None:
+        error = ImageStat.Stat(ImageChops.difference(rgb, indexed.convert('RGB'))).rms
+        if max(error) > max_rms:
+            # Colours the shared palette doesn't cover; the frame is written with its own
+            indexed = rgb.quantize(255, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    if frame.mode == 'RGBA':
+        indexed.paste(255, mask=frame.getchannel('A').point(lambda alpha: 255 if alpha < 128 else 0))
+        indexed.info['transparency'] = 255
+    return indexed
+
+def _working_mode(image):
+    if image.mode in ('RGB', 'RGBA'):
+        return image.mode
+    if image.mode in ('LA', 'PA') or 'transparency' in image.info:
+        return 'RGBA'
+    return 'RGB'
+
+def _composite_region(img, wm, x, y):
+    # Alpha-composite wm onto img in place, touching only the watermark's bounding box.
+    # Same per-pixel maths as pasting into a full-frame transparent layer and compositing that.
+    right, bottom = min(x + wm.width, img.width), min(y + wm.height, img.height)
+    if right <= x or bottom <= y:
+        return
+    if (right - x, bottom - y) != wm.size:
+        wm = wm.crop((0, 0, right - x, bottom - y))
+    layer = Image.new('RGBA', wm.size, (0, 0, 0, 0))
+    layer.paste(wm, (0, 0), wm)
+    region = img.crop((x, y, right, bottom))
+    if region.mode != 'RGBA':
+        region = region.convert('RGBA')
+    blended = Image.alpha_composite(region, layer)
+    img.paste(blended if img.mode == 'RGBA' else blended.convert(img.mode), (x, y))
+
+def _tile_cell(wm, spacing_x, spacing_y):
+    # One period of the tile lattice. Every tile overlapping the cell is pasted in the same
+    # row-major order the full-frame loop used, so overlapping tiles blend identically.
+    cell = Image.new('RGBA', (spacing_x, spacing_y), (0, 0, 0, 0))
+    for y in range(-(wm.height // spacing_y + 1) * spacing_y, spacing_y, spacing_y):
+        for x in range(-(wm.width // spacing_x + 1) * spacing_x, spacing_x, spacing_x):
+            cell.paste(wm, (x, y), wm)
+    return cell
+
+def _repeat(cell, size, offset):
+    # Fill `size` with copies of `cell`, starting `offset` pixels into it. Copies are doubled
+    # each step, so the number of pastes grows with log(size) rather than the tile count.
+    width, height = size[0] + offset[0], size[1] + offset[1]
+    block = cell
+    while block.width < width:
+        wider = Image.new(block.mode, (block.width * 2, block.height))
+        wider.paste(block, (0, 0))
+        wider.paste(block, (block.width, 0))
+        block = wider
+    while block.height < height:
+        taller = Image.new(block.mode, (block.width, block.height * 2))
+        taller.paste(block, (0, 0))
+        taller.paste(block, (0, block.height))
+        block = taller
+    return block.crop((offset[0], offset[1], offset[0] + size[0], offset[1] + size[1]))
+
+
+@dataclass(frozen=True, eq=False)
+class WatermarkPlan:
+    # A validated, immutable watermark job compiled once from a settings dict.
+    # It has no Streamlit dependency, so batch workers can build and reuse it directly.
+    settings: Mapping
+    watermark: Image.Image
+    digest: str
+    pre_effects: tuple
+    resized_effects: tuple
+    rotations: tuple
+    post_effects: tuple
+    position: object
+    output_format: str
+    save_options: Mapping
+    variants: tuple = ()
+    cache: object = None
+    vectorized: object = None
+    strip_pixels: int = STRIP_PIXELS
+
+    @classmethod
+    def compile(cls, settings, watermark_img, cache=prepared_cache, digest=None, vectorized=None):
+        # vectorized: None picks NumPy steps where they are faster (when NumPy is installed),
+        # True runs every effect NumPy can do on one array, False keeps the pure PIL chain
+        settings = MappingProxyType(dict(settings))
+        validate_settings(settings)
+        watermark = watermark_img if watermark_img.mode == 'RGBA' else watermark_img.convert('RGBA')
+        if digest is None and cache is not None:
+            digest = watermark_digest(watermark_img)
+        if vectorized and numpy_effects is None:
+            raise ValueError("vectorized effects need NumPy installed")
+        pre_effects, resized_effects, post_effects = _resolve_effects(settings, vectorized)
+        output_format, save_options = _resolve_encoder(settings)
+        return cls(
+            settings=settings,
+            watermark=watermark,
+            digest=digest,
+            pre_effects=pre_effects,
+            resized_effects=resized_effects,
+            rotations=_resolve_rotations(settings),
+            post_effects=post_effects,
+            position=_resolve_position(settings),
+            output_format=output_format,
+            save_options=MappingProxyType(save_options),
+            variants=output_variants(settings),
+            cache=cache,
+            vectorized=vectorized,
+        )
+
+    def scaled(self, factor):
+        # Same job for an image resized by `factor`, e.g. a reduced-size live preview
+        return WatermarkPlan.compile(scale_settings(self.settings, factor), self.watermark,
+                                     cache=self.cache, digest=self.digest, vectorized=self.vectorized)
+
+    @property
+    def tiled(self):
+        return self.settings.get('tile_watermark', False)
+
+    @property
+    def extension(self):
+        return self.output_format.lower()
+
+    @property
+    def mime_type(self):
+        return f"image/{self.extension}"
+
+    def target_size(self, img_size):
+        return get_watermark_size(img_size[0], img_size[1], self.watermark.width, self.watermark.height,
+                                  self.settings)
+
+    def cache_key(self, img_size):
+        return (self.digest, effective_settings(self.settings), self.target_size(img_size))
+
+    def prepare(self, img_size):
+        if self.cache is not None:
+            key = self.cache_key(img_size)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        wm = self.watermark.copy()
+        for effect in self.pre_effects:
+            with stage(effect.__name__.lstrip('_')) as timer:
+                wm = timer.output(_run_effect(effect, wm, self.settings))
+        target = self.target_size(img_size)
+        if self.resized_effects:
+            # Blur works at the final scale, so it splits the resize from the rotations
+            with stage('resize') as timer:
+                wm = timer.output(_as_image(wm).resize(target, Image.Resampling.LANCZOS))
+            for effect in self.resized_effects:
+                with stage(effect.__name__.lstrip('_')) as timer:
+                    wm = timer.output(_run_effect(effect, wm, self.settings))
+        # Resize and every rotation in a single resample
+        with stage('transform') as timer:
+            wm = timer.output(_transform(_as_image(wm), target, self.rotations))
+        for effect in self.post_effects:
+            with stage(effect.__name__.lstrip('_')) as timer:
+                wm = timer.output(_run_effect(effect, wm, self.settings))
+        wm = _as_image(wm)
+
+        if self.cache is not None:
+            self.cache.put(key, wm)
+        return wm
+
+    def tile_pattern(self, img_size, wm=None, image_size=None):
+        # Full-frame tiled layer, built from one lattice period and cached per image size.
+        # image_size is the image the watermark is sized for when the layer covers only part
+        # of it (a band of strips); the key has to follow the tile size as well as the layer's.
+        image_size = tuple(image_size or img_size)
+        if self.cache is not None:
+            key = ('tile_pattern', self.cache_key(image_size), image_size, tuple(img_size),
+                   self.settings.get('tile_spacing_x', 200), self.settings.get('tile_spacing_y', 200))
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        if wm is None:
+            wm = self.prepare(image_size)
+        with stage('tile_pattern') as timer:
+            cell = _tile_cell(wm, int(self.settings.get('tile_spacing_x', 200)),
+                              int(self.settings.get('tile_spacing_y', 200)))
+            # Tiles start at (-wm.width, -wm.height), so the image origin sits that far into the lattice
+            pattern = timer.output(_repeat(cell, img_size, (wm.width % cell.width, wm.height % cell.height)))
+
+        if self.cache is not None:
+            self.cache.put(key, pattern)
+        return pattern
+
+    def _composite_strips(self, img, wm):
+        # Tiled layer for a huge image, one strip at a time. The pattern repeats every
+        # tile_spacing_y rows, so one strip-high band built from the image origin is the
+        # layer for every strip; only a band and one strip of RGBA exist at any time.
+        period = int(self.settings.get('tile_spacing_y', 200))
+        rows = max(period, self.strip_pixels // img.width // period * period)
+        band = self.tile_pattern((img.width, min(rows, img.height)), wm, image_size=img.size)
+        with stage('composite') as timer:
+            for top in range(0, img.height, rows):
+                bottom = min(top + rows, img.height)
+                layer = band if bottom - top == band.height else band.crop((0, 0, img.width, bottom - top))
+                region = img.crop((0, top, img.width, bottom))
+                if region.mode != 'RGBA':
+                    region = region.convert('RGBA')
+                blended = Image.alpha_composite(region, layer)
+                img.paste(blended if img.mode == 'RGBA' else blended.convert(img.mode), (0, top))
+            timer.output(img)
+
+    def apply(self, image, in_place=False):
+        # Work in the image's own mode where possible: RGB stays RGB, RGBA stays RGBA.
+        # in_place lets a caller that owns a decoded image skip the defensive copy.
+        mode = _working_mode(image)
+        with stage('convert') as timer:
+            if image.mode == mode:
+                img = image if in_place else timer.output(image.copy())
+            else:
+                img = timer.output(image.convert(mode))
+
+        wm = self.prepare(img.size)
+
+        if self.tiled and self.strip_pixels and img.width * img.height > self.strip_pixels:
+            result = img
+            self._composite_strips(result, wm)
+        elif self.tiled:
+            layer = self.tile_pattern(img.size, wm)
+            with stage('composite') as timer:
+                if img.mode == 'RGBA':
+                    result = Image.alpha_composite(img, layer)
+                else:
+                    result = Image.alpha_composite(img.convert('RGBA'), layer).convert(img.mode)
+                timer.output(result)
+        else:
+            x, y = self.position(img.width, img.height, wm.width, wm.height)
+
+            # Ensure watermark is within bounds
+            x = max(0, min(x, img.width - wm.width))
+            y = max(0, min(y, img.height - wm.height))
+
+            result = img
+            with stage('composite') as timer:
+                _composite_region(result, wm, x, y)
+                timer.output(wm)
+
+        # Convert based on output format; variants convert per encoder in encode_variants
+        if self.output_format == 'JPEG' and result.mode != 'RGB' and not self.variants:
+            with stage('convert') as timer:
+                result = timer.output(result.convert('RGB'))
+
+        return result
+
+    def encode(self, image, fp=None):
+        buf = io.BytesIO() if fp is None else fp
+        with stage('encode') as timer:
+            image.save(buf, format=self.output_format, **self.save_options)
+            if fp is None:
+                return timer.output(buf.getvalue())
+        return None
+
+    def encode_variants(self, image):
+        # Every variant from one watermarked full-size image, as encoded bytes in the order
+        # they were listed. The watermark was composited at full size, so its geometry scales
+        # with the image. Sizes are produced largest first, each downscaled from the last.
+        outputs = [None] * len(self.variants)
+        order = sorted(range(len(self.variants)), key=lambda idx: -(self.variants[idx].size or math.inf))
+        longest = max(image.size)
+        current = image
+        for idx in order:
+            variant = self.variants[idx]
+            if variant.size and variant.size < max(current.size):
+                target = (max(1, round(image.width * variant.size / longest)),
+                          max(1, round(image.height * variant.size / longest)))
+                with stage('downscale') as timer:
+                    current = timer.output(current.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0))
+            encodable = current
+            if variant.output_format == 'JPEG' and current.mode != 'RGB':
+                with stage('convert') as timer:
+                    encodable = timer.output(current.convert('RGB'))
+            buf = io.BytesIO()
+            with stage('encode') as timer:
+                encodable.save(buf, format=variant.output_format, **variant.save_options)
+                outputs[idx] = timer.output(buf.getvalue())
+        return outputs
+
+    def keeps_frames(self, image):
+        # Every entry point asks this before decoding, so it is also where an animation too
+        # large to hold whole is refused with ImageTooLarge
+        return self.settings.get('keep_frames', True) and check_frames(image, MAX_ANIMATION_PIXELS) > 1
+
+    def iter_frames(self, image, finish=None, threads=FRAME_THREADS):
+        # Watermarked frames of a multi-frame image as (frame, info) pairs, in order. Frames
+        # are decoded one at a time and blended on a few threads, with at most a small
+        # window of them in flight. The layer is prepared once per frame size rather than
+        # per frame. finish(frame) runs on the same thread right after the blend.
+        plan = self
+        if self.cache is None:
+            plan = replace(self, cache=PreparedWatermarkCache(max_entries=4),
+                           digest=self.digest or watermark_digest(self.watermark))
+        threads = max(1, threads)
+
+        def work(frame):
+            frame = plan.apply(frame, in_place=True)
+            return finish(frame) if finish else frame
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='watermark-frame') as pool:
+            window = deque()
+            for index in range(image.n_frames):
+                image.seek(index)
+                with stage('decode') as timer:
+                    # A copy, since seeking reuses the decoder's frame buffer
+                    frame = timer.output(image.convert(_working_mode(image)))
+                if index == 0:
+                    plan.prepare(frame.size)
+                info = {'duration': image.info.get('duration', 0),
+                        'disposal': getattr(image, 'disposal_method', 0)}
+                # Stage timings of the frame still go to the caller's recorder
+                window.append((pool.submit(contextvars.copy_context().run, work, frame), info))
+                if len(window) > threads * 2:
+                    future, info = window.popleft()
+                    yield future.result(), info
+            while window:
+                future, info = window.popleft()
+                yield future.result(), info
+
+    def _gif_palette(self, image):
+        # Watermarked frames spread evenly over the animation, shrunk without blending their
+        # colours and stacked into one picture for the quantizer
+        count = image.n_frames
+        samples = min(count, GIF_PALETTE_FRAMES)
+        indices = sorted({round(i * (count - 1) / max(1, samples - 1)) for i in range(samples)})
+        with stage('palette') as timer:
+            thumbs = []
+            for index in indices:
+                image.seek(index)
+                frame = self.apply(image.convert(_working_mode(image)), in_place=True).convert('RGB')
+                frame.thumbnail((_GIF_PALETTE_EDGE, _GIF_PALETTE_EDGE), Image.Resampling.NEAREST)
+                thumbs.append(frame)
+            sheet = Image.new('RGB', (max(t.width for t in thumbs), sum(t.height for t in thumbs)))
+            top = 0
+            for thumb in thumbs:
+                sheet.paste(thumb, (0, top))
+                top += thumb.height
+            return timer.output(sheet.quantize(255, method=Image.Quantize.MEDIANCUT))
+
+    def encode_frames(self, image, fp=None):
+        # Multi-frame counterpart of apply + encode. The output keeps the source's format,
+        # frame durations, loop count and GIF disposal; returns the bytes, or writes to fp.
+        output_format = image.format
+        check_frames(image, MAX_ANIMATION_PIXELS)
+        buf = io.BytesIO() if fp is None else fp
+        if output_format == 'TIFF':
+            # Pages are written as they come, so only the blending window is ever in memory
+            compression = image.info.get('compression')
+            options = {'compression': compression if compression in _TIFF_LOSSLESS else 'tiff_lzw'}
+            with TiffImagePlugin.AppendingTiffWriter(buf) as tiff:
+                for frame, _ in self.iter_frames(image):
+                    with stage('encode') as timer:
+                        frame.save(tiff, format='TIFF', **options)
+                        timer.output(frame)
+                    tiff.newFrame()
+        else:
+            finish = None
+            if output_format == 'GIF':
+                # One palette for the whole animation, from a sample of its watermarked frames;
+                # every frame is then mapped onto it (on the blending threads) and held as 1 byte/px
+                finish = partial(_to_palette, palette=self._gif_palette(image))
+            frames, durations, disposals = [], [], []
+            for frame, info in self.iter_frames(image, finish):
+                frames.append(frame)
+                durations.append(info['duration'])
+                disposals.append(info['disposal'])
+            options = {'save_all': True, 'append_images': frames[1:], 'duration': durations,
+                       'loop': image.info.get('loop', 0)}
+            if output_format == 'GIF':
+                options.update(disposal=disposals, optimize=False)
+            else:
+                options.update(_resolve_encoder(dict(self.settings, output_format='WEBP'))[1])
+                if 'background' in image.info:
+                    options['background'] = image.info['background']
+            with stage('encode') as timer:
+                frames[0].save(buf, format=output_format, **options)
+                if fp is None:
+                    # Sized by the encoded bytes, like encode()
+                    return timer.output(buf.getvalue())
+                timer.output(frames[0])
+        if fp is None:
+            return buf.getvalue()
+        return None
+
+
+def prepare_watermark(watermark_img, settings, img_size, cache=None, digest=None):
+    return WatermarkPlan.compile(settings, watermark_img, cache=cache, digest=digest).prepare(img_size)
+
+def apply_watermark(image, watermark_img, settings, cache=None, digest=None):
+    return WatermarkPlan.compile(settings, watermark_img, cache=cache, digest=digest).apply(image)